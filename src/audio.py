@@ -1,9 +1,15 @@
-import subprocess
 import asyncio
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
 
 from scipy.io.wavfile import write
 import numpy as np
 import sounddevice as sd
+import soundfile as sf
 
 import yaml
 
@@ -12,12 +18,87 @@ with open("./config.yaml", 'r') as file:
 
 # Global or shared state to control recording
 is_recording = False
-recording_buffer = []
+recorder = None
 
 ############################################
 # RECORDING FUNCTIONS
 ############################################
 
+class Recorder:
+    """Records from the microphone straight into a WAV file, using constant memory however long it runs.
+
+    The input callback copies each block of samples into a preallocated NumPy chunk. Full
+    chunks are handed to a writer thread, which appends them to the file and returns them
+    for reuse, so nothing is kept around and nothing is touched on the audio thread but the
+    chunk being filled. Stopping only has to write out the chunks still in flight.
+    """
+
+    def __init__(self, output_path, fs=44100, channels=2, chunk_seconds=0.5, pool_chunks=8):
+        self.output_path = output_path
+        self.fs = fs
+        self.channels = channels
+        self.chunk_frames = int(fs * chunk_seconds)
+        self.free_chunks = queue.Queue()
+        for _ in range(pool_chunks):
+            self.free_chunks.put(self._new_chunk())
+        self.full_chunks = queue.Queue()
+        self.chunk = None
+        self.offset = 0
+        self.frames = 0
+        self.stream = None
+        self.file = None
+        self.writer_thread = None
+
+    def _new_chunk(self):
+        return np.empty((self.chunk_frames, self.channels), dtype=np.float32)
+
+    def start(self):
+        self.file = sf.SoundFile(self.output_path, "w", samplerate=self.fs, channels=self.channels, subtype="FLOAT")
+        self.writer_thread = threading.Thread(target=self._write_loop)
+        self.writer_thread.start()
+        self.chunk = self.free_chunks.get()
+        self.offset = 0
+        self.stream = sd.InputStream(samplerate=self.fs, channels=self.channels, dtype="float32", callback=self._callback)
+        self.stream.start()
+
+    def _callback(self, indata, frames, time, status):
+        """This callback is called for each audio block from the input device."""
+        done = 0
+        while done < frames:
+            count = min(frames - done, self.chunk_frames - self.offset)
+            self.chunk[self.offset:self.offset + count] = indata[done:done + count]
+            self.offset += count
+            done += count
+            if self.offset == self.chunk_frames:
+                self.full_chunks.put((self.chunk, self.offset))
+                try:
+                    self.chunk = self.free_chunks.get_nowait()
+                except queue.Empty:
+                    # The disk is falling behind, so grow the pool rather than drop audio
+                    self.chunk = self._new_chunk()
+                self.offset = 0
+        self.frames += frames
+
+    def _write_loop(self):
+        while True:
+            item = self.full_chunks.get()
+            if item is None:
+                break
+            chunk, count = item
+            self.file.write(chunk[:count])
+            self.free_chunks.put(chunk)
+
+    def stop(self):
+        """Stop recording and finish the WAV file."""
+        self.stream.stop()
+        self.stream.close()
+        if self.offset:
+            self.full_chunks.put((self.chunk, self.offset))
+        self.full_chunks.put(None)
+        self.writer_thread.join()
+        self.file.close()
+
+
 async def capture(seconds, output_path):
     fs = 44100  # Sample rate
 
@@ -27,41 +108,44 @@ async def capture(seconds, output_path):
     print("Recording finished.")
     write(output_path, fs, recording)  # Save as WAV file
 
-# Global or shared state to control recording
-is_recording = False
-recording_buffer = []
 
-async def start_recording(fs=44100, channels=2):
+async def start_recording(fs=44100, channels=2, output_path=None):
+    """Record until stop_recording is called. The audio is written to output_path as it comes in,
+    or to a temporary file in the data directory that stop_recording moves into place."""
     global is_recording
-    global recording_buffer
-    
-    def callback(indata, frames, time, status):
-        """This callback is called for each audio block from the input device."""
-        recording_buffer.extend(indata.copy())
+    global recorder
+
+    if output_path is None:
+        handle, output_path = tempfile.mkstemp(suffix=".wav", dir=config["data_dir"])
+        os.close(handle)
 
     print("Starting recording...")
     is_recording = True
-    recording_buffer = []
-    stream = sd.InputStream(samplerate=fs, channels=channels, callback=callback)
-    with stream:
-        while is_recording:
-            await asyncio.sleep(0.1)  # Sleep briefly to yield control
+    recorder = Recorder(output_path, fs=fs, channels=channels)
+    recorder.start()
+    while is_recording:
+        await asyncio.sleep(0.1)  # Sleep briefly to yield control
     print("Recording stopped.")
 
 
 async def stop_recording(output_path, fs=44100):
     global is_recording
-    global recording_buffer
+    global recorder
     
     is_recording = False
-    await asyncio.sleep(0.2)  # Wait a bit for the recording loop to finish
+    if recorder is None:
+        print("Recording was empty.")
+        return
+    finished, recorder = recorder, None
+    await asyncio.to_thread(finished.stop)
     
-    if recording_buffer:
-        # Convert buffer to numpy array and write to WAV file
-        recording = np.array(recording_buffer)
-        write(output_path, fs, recording)
+    if finished.frames:
+        if os.path.abspath(finished.output_path) != os.path.abspath(output_path):
+            # A rename when both are on the same file system
+            shutil.move(finished.output_path, output_path)
         print(f"Recording saved to {output_path}.")
     else:
+        os.remove(finished.output_path)
         print("Recording was empty.")
 
 
@@ -69,7 +153,227 @@ async def stop_recording(output_path, fs=44100):
 # PLAYBACK FUNCTIONS
 ############################################
 
-async def stream(audio_stream):
+class Player:
+    """A long-lived mpv process that plays an MP3 byte stream from its stdin.
+
+    The process is started on first use and reused for every reply, so no process is spawned
+    on the latency path. Chunks go through a bounded queue to a writer task that awaits the
+    pipe draining, so the event loop never blocks on a full pipe.
+
+    mpv reads ahead of what it plays and can't be asked how far it has got over a pipe, so
+    playback is tracked by the clock from the duration of each chunk, where it is given.
+    """
+
+    def __init__(self, mpv_path, buffer_chunks=64):
+        self.mpv_path = mpv_path
+        self.buffer_chunks = buffer_chunks
+        self.process = None
+        self.queue = None
+        self.writer_task = None
+        self.written_s = 0.0  # Seconds of audio written so far
+        self.ends_at = 0.0    # When the audio written so far will have played, by time.monotonic()
+
+    async def start(self):
+        """Start the player process, unless it is already running."""
+        if self.writer_task is not None and not self.writer_task.done():
+            return
+        if self.process is not None and self.process.returncode is None:
+            # The writer gave up on this process, so replace it
+            self.process.kill()
+            await self.process.wait()
+        self.process = await asyncio.create_subprocess_exec(
+            self.mpv_path, "--no-cache", "--no-terminal", "--", "fd://0",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+        self.queue = asyncio.Queue(maxsize=self.buffer_chunks)
+        self.writer_task = asyncio.create_task(self._write_loop(self.process, self.queue))
+
+    async def _write_loop(self, process, chunks):
+        while True:
+            chunk = await chunks.get()
+            try:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                print("Audio player exited unexpectedly, restarting on the next chunk.")
+                chunks.task_done()
+                # Release anyone waiting on the remaining chunks of the dead process
+                while not chunks.empty():
+                    chunks.get_nowait()
+                    chunks.task_done()
+                return
+            chunks.task_done()
+
+    async def write(self, chunk, seconds=None):
+        """Queue a chunk for playback, waiting only if the buffer is full.
+        Pass the chunk's duration in seconds to have drain() wait for it to play."""
+        await self.start()
+        await self.queue.put(chunk)
+        if seconds is not None:
+            self.written_s += seconds
+            self.ends_at = max(time.monotonic(), self.ends_at) + seconds
+
+    async def drain(self):
+        """Wait until every queued chunk has been handed to the player and played."""
+        if self.queue is not None:
+            await self.queue.join()
+        await asyncio.sleep(max(0.0, self.ends_at - time.monotonic()))
+
+    def written_seconds(self):
+        return self.written_s
+
+    def played_seconds(self):
+        return self.written_s - max(0.0, self.ends_at - time.monotonic())
+
+    async def flush(self):
+        """Stop playback at once, dropping everything queued or buffered.
+        mpv can't be told to drop what it has buffered over a pipe, so the process is replaced."""
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            self.writer_task = None
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+        self.ends_at = time.monotonic()
+        await self.start()
+
+    async def close(self):
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            self.writer_task = None
+        if self.process is not None and self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                # mpv exits once it has played out what is left in the pipe
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self.process = None
+
+
+class PcmPlayer:
+    """In-process playback of raw 16-bit mono PCM through sounddevice.
+
+    Samples are copied into a preallocated ring buffer that the output callback reads from, so
+    there is no subprocess and no decoding. Playback of a reply starts once prebuffer_ms of
+    audio is queued. Whenever the callback runs dry in the middle of a reply it counts an
+    underrun and plays silence for the missing frames.
+    """
+
+    def __init__(self, sample_rate, buffer_seconds=30, prebuffer_ms=60):
+        self.sample_rate = sample_rate
+        self.ring = np.zeros(int(sample_rate * buffer_seconds), dtype=np.int16)
+        self.prebuffer_frames = int(sample_rate * prebuffer_ms / 1000)
+        # Total frames written and read, the ring positions are these modulo its size
+        self.written = 0
+        self.read = 0
+        self.playing = False   # Past the prebuffer for the current reply
+        self.finishing = False  # The reply has ended, so play out whatever is left
+        self.leftover = b""    # An odd trailing byte from the last chunk
+        self.underruns = 0
+        self.underrun_frames = 0
+        self.lock = threading.Lock()
+        self.output = None
+
+    async def start(self):
+        if self.output is not None:
+            return
+        self.output = sd.OutputStream(
+            samplerate=self.sample_rate, channels=1, dtype="int16", callback=self._callback
+        )
+        self.output.start()
+
+    def _callback(self, outdata, frames, time, status):
+        """Called from the audio thread for every output block."""
+        with self.lock:
+            available = self.written - self.read
+            if not self.playing:
+                if available >= self.prebuffer_frames or (self.finishing and available > 0):
+                    self.playing = True
+                else:
+                    outdata.fill(0)
+                    return
+
+            count = min(frames, available)
+            start = self.read % len(self.ring)
+            first = min(count, len(self.ring) - start)
+            outdata[:first, 0] = self.ring[start:start + first]
+            outdata[first:count, 0] = self.ring[:count - first]
+            outdata[count:] = 0
+            self.read += count
+
+            if count < frames:
+                if not self.finishing:
+                    self.underruns += 1
+                    self.underrun_frames += frames - count
+                # Wait for a full prebuffer again before resuming
+                self.playing = False
+
+    async def write(self, chunk, seconds=None):
+        """Queue PCM bytes, waiting while the ring buffer is full.
+        The duration is known from the samples, so seconds is ignored."""
+        await self.start()
+        chunk = self.leftover + chunk
+        usable = len(chunk) - len(chunk) % 2
+        self.leftover = chunk[usable:]
+        samples = np.frombuffer(chunk[:usable], dtype="<i2")
+
+        with self.lock:
+            self.finishing = False
+        offset = 0
+        while offset < len(samples):
+            with self.lock:
+                space = len(self.ring) - (self.written - self.read)
+                count = min(space, len(samples) - offset)
+                start = self.written % len(self.ring)
+                first = min(count, len(self.ring) - start)
+                self.ring[start:start + first] = samples[offset:offset + first]
+                self.ring[:count - first] = samples[offset + first:offset + count]
+                self.written += count
+            offset += count
+            if offset < len(samples):
+                await asyncio.sleep(0.01)
+
+    async def drain(self):
+        """Mark the end of the reply and wait until it has all been played."""
+        with self.lock:
+            self.finishing = True
+            self.leftover = b""
+        while self.written > self.read:
+            await asyncio.sleep(0.01)
+
+    def written_seconds(self):
+        return self.written / self.sample_rate
+
+    def played_seconds(self):
+        return self.read / self.sample_rate
+
+    async def flush(self):
+        """Stop playback at once, dropping whatever is left in the ring buffer."""
+        with self.lock:
+            self.read = self.written
+            self.playing = False
+            self.finishing = False
+            self.leftover = b""
+
+    async def close(self):
+        if self.output is not None:
+            self.output.stop()
+            self.output.close()
+            self.output = None
+        if self.underruns:
+            print(f"Audio underruns: {self.underruns} ({self.underrun_frames / self.sample_rate * 1000:.0f}ms of silence)")
+
+
+if config.get("audio_output", "mpv") == "pcm":
+    player = PcmPlayer(config["pcm_sample_rate"], prebuffer_ms=config.get("pcm_prebuffer_ms", 60))
+else:
+    player = Player(config["mpv_path"])
+
+
+async def stream(audio_stream, timer=None, bytes_per_second=None):
     # TODO: Fix installation check
     # """Stream audio data using mpv player."""
     # if not is_installed("mpv"):
@@ -78,36 +382,36 @@ async def stream(audio_stream):
     #         "Install instructions: https://mpv.io/installation/"
     #     )
 
-    mpv_process = subprocess.Popen(
-        [config["mpv_path"], "--no-cache", "--no-terminal", "--", "fd://0"],
-        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-    )
-
     print("Started streaming audio")
     async for chunk in audio_stream:
         if chunk:
-            mpv_process.stdin.write(chunk)
-            mpv_process.stdin.flush()
-
-    if mpv_process.stdin:
-        mpv_process.stdin.close()
-    mpv_process.wait()
+            await player.write(chunk, len(chunk) / bytes_per_second if bytes_per_second else None)
+            if timer is not None:
+                timer.mark("first_audio_written")
+    await player.drain()
     
 
-async def play_file(file_path):
-    # Use the full path to the mpv executable if it's not in your system's PATH environment variable
-    mpv_executable = config["mpv_path"]
-
-    # Start mpv to play the specified audio file
-    mpv_process = subprocess.Popen(
-        [mpv_executable, "--no-cache", "--no-terminal", file_path],
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-    )
-
+async def play_file(file_path, chunk_size=64 * 1024):
     print(f"Started playing {file_path}")
 
-    # Wait for mpv to finish playing the file
-    await asyncio.to_thread(mpv_process.wait)
+    if isinstance(player, Player) and file_path.lower().endswith(".mp3"):
+        # MP3s can go through the persistent player, since its input is an MP3 stream anyway
+        with open(file_path, "rb") as file:
+            while True:
+                chunk = await asyncio.to_thread(file.read, chunk_size)
+                if not chunk:
+                    break
+                await player.write(chunk)
+        await player.drain()
+    else:
+        # Use the full path to the mpv executable if it's not in your system's PATH environment variable
+        mpv_process = await asyncio.create_subprocess_exec(
+            config["mpv_path"], "--no-cache", "--no-terminal", file_path,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+        # Wait for mpv to finish playing the file
+        await mpv_process.wait()
+
     print(f"Finished playing {file_path}")
 
 
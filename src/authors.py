@@ -1,3 +1,4 @@
+import asyncio
 import gpt_synchonous as gpt
 import json
 import yaml
@@ -9,7 +10,7 @@ from settings import config
 authors_list = ['William Shakespeare', 'Jane Austen', 'Mark Twain', 'Charles Dickens', 'Arthur Conan Doyle', 'H.P. Lovecraft', 'Ernest Hemingway', 'George Orwell', 'Leo Tolstoy', 'Emily Dickinson', 'Edgar Allan Poe', 'Fyodor Dostoevsky', 'Virginia Woolf', 'James Joyce', 'Haruki Murakami', 'J.K. Rowling', 'J.R.R. Tolkien', 'Gabriel García Márquez', 'Toni Morrison', 'Langston Hughes', 'Sylvia Plath', 'Herman Melville', 'Mary Shelley', 'Franz Kafka', 'Agatha Christie', 'Oscar Wilde', 'Charles Baudelaire', 'Italo Calvino', 'Margaret Atwood', 'Chinua Achebe', 'Zora Neale Hurston', 'Kurt Vonnegut', 'Ray Bradbury', 'George R.R. Martin', 'Alice Walker', 'Kazuo Ishiguro', 'Philip K. Dick', 'Toni Cade Bambara', 'Isabel Allende', 'T.S. Eliot', 'Louisa May Alcott', 'Dante Alighieri', 'Nikolai Gogol', 'Anton Chekhov', 'W.B. Yeats', 'Henry James', 'Octavia E. Butler', 'Samuel Beckett', 'Gustave Flaubert', 'James Baldwin', 'John Steinbeck', 'Maya Angelou', 'F. Scott Fitzgerald', 'Hermann Hesse', 'Jorge Luis Borges', 'Salman Rushdie', 'Ursula K. Le Guin', 'David Foster Wallace', 'Elena Ferrante', 'Yukio Mishima', 'Cormac McCarthy', 'Rumi', 'J.D. Salinger', 'Clarice Lispector', 'Françoise Sagan', 'Amos Oz', "Ngũgĩ wa Thiong'o", 'Joan Didion', 'Khaled Hosseini', 'Albert Camus', 'Anne Carson', 'Banana Yoshimoto', 'Charles Bukowski', 'Don DeLillo', 'Eudora Welty', "Flannery O'Connor", 'Günter Grass', 'Harper Lee', 'Iris Murdoch', 'Jack Kerouac', 'Kenzaburō Ōe', 'Lorrie Moore', 'Mikhail Bulgakov', 'Nawal El Saadawi', 'Octavio Paz', 'Patricia Highsmith']
 
 class Author:
-    def __init__(self, name):
+    def __init__(self, name, load=True):
         self.name = name
         self.genre = None
         self.complexity = 0
@@ -19,7 +20,10 @@ class Author:
         self.devices = []
 
         self.author_file_path = os.path.join(config["authors_dir"], f"{self.name}.json")
-        self.load_author_file()        
+        
+        # Pass load=False when constructing from inside an event loop, then await aload_author_file()
+        if load:
+            self.load_author_file()
 
 
         
@@ -27,17 +31,26 @@ class Author:
         return f"{self.name}: {self.genre}, Complexity: {self.complexity}, Poeticism: {self.poeticism}, Themes: {self.themes}, Devices: {self.devices}, Vocab: {self.vocab}"   
 
     def initalize_author(self):
-        self.get_themes()
-        self.get_devices()
-        self.get_genre()
-        self.get_complexity()
-        self.get_poeticism()
-        self.get_vocab(150)
+        gpt.run_sync(self.ainitalize_author())
+
+    async def ainitalize_author(self):
+        # None of the author attributes depend on each other, so request them all at once
+        await asyncio.gather(
+            self.aget_themes(),
+            self.aget_devices(),
+            self.aget_genre(),
+            self.aget_complexity(),
+            self.aget_poeticism(),
+            self.aget_vocab(150),
+        )
         
     def get_vocab(self, vocab_size=150):
+        return gpt.run_sync(self.aget_vocab(vocab_size))
+
+    async def aget_vocab(self, vocab_size=150):
         '''Prompt ChatGPT to return a list of vocabulary specific to the author'''
         
-        def update_vocab():
+        async def update_vocab():
             max_words_per_request = 75
             words_to_request = vocab_size - len(self.vocab)
             if words_to_request > max_words_per_request:
@@ -51,20 +64,18 @@ class Author:
                 current_vocab = " ".join(self.vocab)
                 prompt += f" The current list of words for {self.name} has already been recorded: {current_vocab}. Do not repeat these words or any varients of them."
             
-            response = gpt.get_synchonous_response(prompt, temperature=0.05, model="gpt-4-turbo")
+            response = await gpt.get_async_response(prompt, temperature=0.05, model="gpt-4-turbo", stage="author.vocab")
             vocab = response.replace(".", "").replace(",", "").replace("\n", " ").strip().split(" ")
             for word in vocab:
                 if word.lower() not in self.vocab:
                     self.vocab.append(word.lower())
             
             self.save_author_file()
-                   
-            # Continue to request words until the vocab list is at least the desired size
-            if len(self.vocab) < vocab_size:
-                update_vocab()
         
         if len(self.vocab) < vocab_size:
-            update_vocab()
+            # Each request depends on the words already recorded, so these have to stay sequential
+            while len(self.vocab) < vocab_size:
+                await update_vocab()
             print("Vocab size:", len(self.vocab))
             print("Vocab:", self.vocab)
         
@@ -72,11 +83,14 @@ class Author:
         return self.vocab
         
     def get_themes(self):
+        return gpt.run_sync(self.aget_themes())
+
+    async def aget_themes(self):
         
         if self.themes is None or len(self.themes) == 0:
             print(f"Generating themes for {self.name}.")
             prompt = f"Generate a space separated list of recurring themes that {self.name} is known for writing about. This will be processed directly by a script, so output nothing but the list."
-            response = gpt.get_synchonous_response(prompt)
+            response = await gpt.get_async_response(prompt, stage="author.themes")
             themes = response.split(" ")
             for theme in themes:
                 self.themes.append(theme.lower())
@@ -85,11 +99,14 @@ class Author:
         return self.themes
 
     def get_devices(self):
+        return gpt.run_sync(self.aget_devices())
+
+    async def aget_devices(self):
         
         if self.devices is None or len(self.devices) == 0:
             print(f"Generating literary devices for {self.name}.")
             prompt = f"Generate a space separated list of literary devices that {self.name} is known for using in their writing. This will be processed directly by a script, so output nothing but the list."
-            response = gpt.get_synchonous_response(prompt)
+            response = await gpt.get_async_response(prompt, stage="author.devices")
             devices = response.split(" ")
             for device in devices:
                 self.devices.append(device.lower())
@@ -98,28 +115,38 @@ class Author:
         return self.devices
         
     def get_genre(self):
+        return gpt.run_sync(self.aget_genre())
+
+    async def aget_genre(self):
         if self.genre is None:
             print(f"Generating genre for {self.name}.")
             prompt = f"Output the genre {self.name} is most known for writing in. This will be processed directly by a script, so output nothing but the description."
-            response = gpt.get_synchonous_response(prompt)
+            response = await gpt.get_async_response(prompt, stage="author.genre")
             self.genre = response.lower()
             self.save_author_file()
             print("Genre:", self.genre)
+        return self.genre
         
     def get_complexity(self):
+        return gpt.run_sync(self.aget_complexity())
+
+    async def aget_complexity(self):
         if self.complexity == 0:
             print(f"Generating complexity rating for {self.name}.")
             prompt = f"Output a complexity rating for {self.name}'s writing style on a scale of 1-10. This will be processed directly by a script, so output nothing but the number."
-            response = gpt.get_synchonous_response(prompt)
+            response = await gpt.get_async_response(prompt, stage="author.complexity")
             self.complexity = int(response)
             self.save_author_file()
             print("Complexity:", self.complexity)
         return self.complexity
         
     def get_poeticism(self):
+        return gpt.run_sync(self.aget_poeticism())
+
+    async def aget_poeticism(self):
         if self.poeticism == 0:
             prompt = f"Output a poeticism rating for {self.name}'s writing style on a scale of 1-10. This will be processed directly by a script, so output nothing but the number."
-            response = gpt.get_synchonous_response(prompt)
+            response = await gpt.get_async_response(prompt, stage="author.poeticism")
             self.poeticism = int(response)
             self.save_author_file()
             print("Poeticism:", self.poeticism)
@@ -142,15 +169,35 @@ class Author:
             json.dump(data_to_save, file, indent=4, sort_keys=True)
 
     def load_author_file(self):
+        gpt.run_sync(self.aload_author_file())
+
+    async def aload_author_file(self):
         if os.path.exists(self.author_file_path):
             print(f"Loading {self.name} from JSON.")
             with open(self.author_file_path, "r") as file:
                 data = json.load(file)
                 self.__dict__.update(data)
-            self.get_vocab(150)
+            await self.aget_vocab(150)
         else:
-            self.initalize_author()
+            await self.ainitalize_author()
             
+_author_tasks = {}
+
+async def get_author(name):
+    """Return a loaded Author, sharing one bootstrap between every concurrent caller asking for the same name."""
+    if name not in _author_tasks:
+        async def load():
+            author = Author(name, load=False)
+            await author.aload_author_file()
+            return author
+        _author_tasks[name] = asyncio.ensure_future(load())
+    try:
+        return await _author_tasks[name]
+    except Exception:
+        # Let the next caller retry instead of re-raising a stale failure
+        _author_tasks.pop(name, None)
+        raise
+
 def get_initialized_authors():
     author_files = os.listdir(config["authors_dir"])
     for file in author_files:
@@ -0,0 +1,91 @@
+###### Standard Imports ######
+import argparse
+import asyncio
+import os
+import time
+
+###### Local Imports ######
+import gpt_synchonous as gpt
+from authors import authors_list
+from settings import config
+from story import Story
+
+###### Global Vars ######
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+
+
+###### Functions ######
+
+def list_images(images_dir):
+    return sorted(
+        name for name in os.listdir(images_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def get_story_name(image_name, author_name):
+    return f"{os.path.splitext(image_name)[0]} - {author_name}"
+
+
+async def run_batch(image_names, author_names, images_dir=config["images_dir"], concurrency=config["batch_concurrency"], tokens_per_minute=config["batch_tokens_per_minute"]):
+    """Generate a story for every image / author pair, with at most `concurrency` stories in flight.
+    Stories that already have a <story>.checkpoints.jsonl log in the stories directory resume from their last finished stage.
+
+    Args:
+        image_names (list[str]): Image file names inside images_dir
+        author_names (list[str]): Authors to write a story for each image
+        images_dir (str, optional): Directory holding the images. Defaults to config["images_dir"].
+        concurrency (int, optional): Maximum number of stories generated at once. Defaults to config["batch_concurrency"].
+        tokens_per_minute (int, optional): Token throughput limit across all requests. Defaults to config["batch_tokens_per_minute"].
+    Returns:
+        dict: Counts of completed and failed stories
+    """
+    gpt.set_token_budget(tokens_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {"completed": 0, "failed": 0}
+    total = len(image_names) * len(author_names)
+
+    # Images outside the configured directory are passed by full path
+    use_path = os.path.abspath(images_dir) != os.path.abspath(config["images_dir"])
+
+    async def run_story(image_name, author_name):
+        story_name = get_story_name(image_name, author_name)
+        async with semaphore:
+            try:
+                image = os.path.join(images_dir, image_name) if use_path else image_name
+                story = Story(story_name, author_name, image_name=image, load_author=False)
+                await story.agenerate()
+                counts["completed"] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"Story {story_name} failed: {type(e).__name__}: {e}")
+            print(f"Finished {counts['completed'] + counts['failed']} of {total} stories.")
+
+    start = time.monotonic()
+    await asyncio.gather(*(
+        run_story(image_name, author_name)
+        for image_name in image_names
+        for author_name in author_names
+    ))
+    elapsed = time.monotonic() - start
+
+    stories_per_hour = counts["completed"] / elapsed * 3600 if elapsed > 0 else 0
+    print(f"Completed {counts['completed']} stories ({counts['failed']} failed) in {elapsed:.1f}s: {stories_per_hour:.1f} stories/hour.")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate stories for every image / author pair.")
+    parser.add_argument("--images-dir", default=config["images_dir"], help="directory of images to write stories about")
+    parser.add_argument("--authors", nargs="*", default=authors_list, help="authors to write a story for each image")
+    parser.add_argument("--concurrency", type=int, default=config["batch_concurrency"], help="maximum number of stories generated at once")
+    parser.add_argument("--tokens-per-minute", type=int, default=config["batch_tokens_per_minute"], help="token throughput limit, 0 for no limit")
+    args = parser.parse_args()
+
+    image_names = list_images(args.images_dir)
+    print(f"Generating stories for {len(image_names)} images and {len(args.authors)} authors.")
+    asyncio.run(run_batch(image_names, args.authors, args.images_dir, args.concurrency, args.tokens_per_minute))
+
+
+if __name__ == "__main__":
+    main()
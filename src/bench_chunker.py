@@ -0,0 +1,108 @@
+###### Standard Imports ######
+import argparse
+import json
+import re
+import time
+
+###### Local Imports ######
+from chunker import ChunkPolicy, TextChunker, SENTENCE, CLAUSE
+from latency import percentile
+
+###### Global Vars ######
+POLICIES = {
+    "sentence": ChunkPolicy(SENTENCE),
+    "clause": ChunkPolicy(CLAUSE),
+    "clause, min 20 chars": ChunkPolicy(CLAUSE, min_chars=20),
+    "sentence, max 80 chars": ChunkPolicy(SENTENCE, max_chars=80),
+    "sentence, max 300 ms": ChunkPolicy(SENTENCE, max_wait_ms=300),
+    "clause, max 150 ms": ChunkPolicy(CLAUSE, max_wait_ms=150),
+}
+
+
+###### Functions ######
+
+def load_recorded_streams(path):
+    """Load token streams recorded by chat_completion (see token_stream_log in config.yaml).
+    Each stream is a list of (text, arrival time in ms) pairs."""
+    streams = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                streams.append([(text, ms) for text, ms in json.loads(line)["tokens"]])
+    return streams
+
+
+def synthesize_stream(text, token_ms):
+    """Split plain text into token-sized pieces the way the API streams them, e.g. " word" or "."."""
+    pieces = re.findall(r"\s*[^\W\d_]{1,6}|\s*\d{1,3}|\s*[^\w\s]|\s+", text)
+    return [(piece, (i + 1) * token_ms) for i, piece in enumerate(pieces)]
+
+
+def measure_throughput(streams, policy, repeats):
+    token_count = sum(len(stream) for stream in streams) * repeats
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for stream in streams:
+            chunker = TextChunker(policy, clock=lambda: 0.0)
+            for text, _ in stream:
+                chunker.feed(text)
+            chunker.flush()
+    return token_count / (time.perf_counter() - start)
+
+
+def measure_latency(stream, policy):
+    """Replay a stream against a simulated clock and return the time to the first chunk and the chunk sizes."""
+    now = [0.0]
+    chunker = TextChunker(policy, clock=lambda: now[0])
+    first_chunk_ms = None
+    sizes = []
+    for text, arrival_ms in stream:
+        now[0] = arrival_ms / 1000
+        chunks = chunker.feed(text)
+        if chunks and first_chunk_ms is None:
+            first_chunk_ms = arrival_ms
+        sizes.extend(len(chunk) for chunk in chunks)
+    rest = chunker.flush()
+    if rest:
+        sizes.append(len(rest))
+        if first_chunk_ms is None:
+            first_chunk_ms = stream[-1][1]
+    return first_chunk_ms or 0.0, sizes
+
+
+def run_benchmark(streams, repeats):
+    print(f"{len(streams)} streams, {sum(len(stream) for stream in streams)} tokens")
+    header = f"{'policy':<26}{'tokens/s':>12}{'p50 ttfc ms':>14}{'p95 ttfc ms':>14}{'mean chunk':>12}"
+    print(header)
+    print("-" * len(header))
+    for name, policy in POLICIES.items():
+        tokens_per_second = measure_throughput(streams, policy, repeats)
+        first_chunks = []
+        sizes = []
+        for stream in streams:
+            first_chunk_ms, stream_sizes = measure_latency(stream, policy)
+            first_chunks.append(first_chunk_ms)
+            sizes.extend(stream_sizes)
+        mean_size = sum(sizes) / len(sizes) if sizes else 0
+        print(f"{name:<26}{tokens_per_second:>12.0f}{percentile(first_chunks, 0.5):>14.0f}{percentile(first_chunks, 0.95):>14.0f}{mean_size:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure text chunker throughput and time to first chunk.")
+    parser.add_argument("--streams", help="JSONL file of recorded token streams")
+    parser.add_argument("--text", nargs="*", default=[], help="plain text files to replay as synthetic streams")
+    parser.add_argument("--token-ms", type=float, default=25, help="token interval for synthetic streams")
+    parser.add_argument("--repeats", type=int, default=20, help="passes over the streams for the throughput figure")
+    args = parser.parse_args()
+
+    streams = load_recorded_streams(args.streams) if args.streams else []
+    for path in args.text:
+        with open(path, "r", encoding="utf-8") as file:
+            # One stream per paragraph, roughly one reply each
+            for paragraph in file.read().split("\n\n"):
+                if paragraph.strip():
+                    streams.append(synthesize_stream(paragraph, args.token_ms))
+    if not streams:
+        parser.error("Provide recorded streams with --streams or text files with --text.")
+    run_benchmark(streams, args.repeats)
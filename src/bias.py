@@ -1,6 +1,17 @@
-import tiktoken 
+###### Standard Imports ######
+import hashlib
+import json
+import os
+
+###### Local Imports ######
+from settings import config
+
+###### Global Vars ######
+ENCODING_NAME = "cl100k_base"
+# The chat completions API rejects logit_bias maps with more entries than this
+LOGIT_BIAS_LIMIT = 300
+BANNED_TOKEN_BIAS = -1
 
-encoding = tiktoken.get_encoding("cl100k_base")
 banned_words = [
     "symphony", "silent", "tapestry", "whispered", "smile", "bustling", 
     "navigating", "realm", "embark", "virtuoso", "vibrant", "nestled",
@@ -20,15 +31,75 @@ banned_words = [
     "silent declaration", "instances of a 'city' performing actions", "unwavering",
     "quiet act of"
     ]
-banned_tokens = []
 
-for word in banned_words:
-    banned_tokens.extend(encoding.encode(word))
+_bias = None
+
+
+###### Classes ######
+
+class FrozenBias(dict):
+    """A dict that can't be modified, so one logit bias table can be shared by every request.
+    It stays a dict subclass because the request body and the response cache key are JSON encoded."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("The logit bias table is shared and can't be modified. Copy it with dict() first.")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+
+###### Functions ######
+
+def get_word_variants(word):
+    # Mid-sentence forms are by far the most common, so they are listed first and survive the size cap
+    forms = [word.lower(), word[:1].upper() + word[1:].lower(), word.upper()]
+    variants = []
+    for form in forms:
+        variants.extend([" " + form, form])
+    return variants
+
+
+def compile_banned_tokens(words, encoding_name=ENCODING_NAME, limit=LOGIT_BIAS_LIMIT):
+    """Encode every case and leading space variant of the banned words, deduplicated and capped to the API limit."""
+    import tiktoken  # Deferred so importing this module doesn't pay tiktoken's startup cost
+
+    encoding = tiktoken.get_encoding(encoding_name)
+    tokens = {}  # Used as an ordered set
+    # Take each word's variants in turn, so that the cap drops rarer variants before whole words
+    variant_lists = [get_word_variants(word) for word in dict.fromkeys(words)]
+    for rank in range(max(len(variants) for variants in variant_lists)):
+        for variants in variant_lists:
+            if rank < len(variants):
+                for token in encoding.encode(variants[rank]):
+                    tokens[token] = None
+    return list(tokens)[:limit]
+
+
+def get_table_path(words, encoding_name=ENCODING_NAME, limit=LOGIT_BIAS_LIMIT):
+    key = json.dumps({"words": words, "encoding": encoding_name, "limit": limit, "variants": 1})
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(config["bias_cache_dir"], f"{encoding_name}_{digest}.json")
+
+
+def load_banned_tokens(words=banned_words, encoding_name=ENCODING_NAME):
+    """Load the compiled token list for this word list and encoding, compiling it on the first run."""
+    path = get_table_path(words, encoding_name)
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            return json.load(file)
+
+    tokens = compile_banned_tokens(words, encoding_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(tokens, file)
+    os.replace(temp_path, path)
+    return tokens
 
-print(banned_tokens)
 
 def get_bias():
-    bias = {}
-    for token in banned_tokens:
-        bias[token] = -1
-    return bias
\ No newline at end of file
+    """Return the shared, read-only logit bias table for the banned words."""
+    global _bias
+    if _bias is None:
+        _bias = FrozenBias((token, BANNED_TOKEN_BIAS) for token in load_banned_tokens())
+    return _bias
@@ -0,0 +1,112 @@
+###### Standard Imports ######
+import argparse
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+###### Local Imports ######
+from latency import percentile
+from settings import config
+
+###### Global Vars ######
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+###### Functions ######
+
+def _write_loop(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as file:
+        while True:
+            record = _queue.get()
+            if record is None:
+                break
+            file.write(json.dumps(record) + "\n")
+            # Only flush once the queue is drained, so bursts of calls share one write
+            if _queue.empty():
+                file.flush()
+
+
+def _stop_writer():
+    if _writer is not None:
+        _queue.put(None)
+        _writer.join(timeout=2)
+
+
+def record(stage, model, latency, ttft=None, prompt_tokens=None, completion_tokens=None, cache_hit=False):
+    """Append one API call to the trace log. The write happens on a background thread,
+    so this only costs a queue put on the calling thread.
+
+    Args:
+        stage (str): Name of the pipeline stage that made the call, e.g. "story.image_notes"
+        model (str): The model the request was sent to
+        latency (float): Seconds from sending the request to receiving the full response
+        ttft (float, optional): Seconds until the first token arrived. Defaults to the latency for non-streamed calls.
+        prompt_tokens (int, optional): Prompt tokens reported by the API
+        completion_tokens (int, optional): Completion tokens reported by the API
+        cache_hit (bool, optional): Whether the response came from the response cache
+    """
+    global _writer
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_write_loop, args=(config["trace_path"],), daemon=True)
+                _writer.start()
+                atexit.register(_stop_writer)
+
+    _queue.put({
+        "time": time.time(),
+        "stage": stage,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "latency": round(latency, 4),
+        "ttft": round(ttft if ttft is not None else latency, 4),
+        "cache_hit": cache_hit,
+    })
+
+
+def report(path=config["trace_path"]):
+    """Print per-stage call counts, cache hit rates, latencies and token totals from the trace log."""
+    stages = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            stages.setdefault(entry["stage"] or "unknown", []).append(entry)
+
+    header = f"{'stage':<28}{'calls':>7}{'hits':>7}{'p50 lat':>10}{'p95 lat':>10}{'p50 ttft':>10}{'prompt tok':>12}{'compl tok':>12}"
+    print(header)
+    print("-" * len(header))
+    for stage, entries in sorted(stages.items()):
+        # Cache hits would drag the latency figures towards zero, so only API calls count there
+        api_calls = [entry for entry in entries if not entry["cache_hit"]]
+        latencies = [entry["latency"] for entry in api_calls]
+        ttfts = [entry["ttft"] for entry in api_calls]
+        hits = len(entries) - len(api_calls)
+        prompt_tokens = sum(entry["prompt_tokens"] or 0 for entry in api_calls)
+        completion_tokens = sum(entry["completion_tokens"] or 0 for entry in api_calls)
+        print(
+            f"{stage:<28}{len(entries):>7}{hits:>7}"
+            f"{percentile(latencies, 0.5):>10.2f}{percentile(latencies, 0.95):>10.2f}{percentile(ttfts, 0.5):>10.2f}"
+            f"{prompt_tokens:>12}{completion_tokens:>12}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the API call trace log.")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("--path", default=config["trace_path"], help="trace log to read")
+    args = parser.parse_args()
+    if args.command == "report":
+        report(args.path)
@@ -0,0 +1,275 @@
+###### Standard Imports ######
+import argparse
+import asyncio
+import json
+import time
+
+###### Third-Party Imports ######
+from openai import AsyncOpenAI
+import websockets
+
+###### Local Imports ######
+import call_trace
+from conversation import Conversation
+import image_store
+import settings
+from settings import config
+
+###### Global Vars ######
+aclient = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, base_url=config.get("chat_base_url"))
+
+
+###### Classes ######
+
+class Client:
+    """One connected typewriter: its channels, its own set of conversations and the reply in flight.
+
+    Everything sent to the client goes through a bounded queue drained by a writer task, so a
+    slow connection never holds up the fan out to the others. A client that falls a whole
+    queue behind is disconnected.
+    """
+
+    def __init__(self, name, websocket, send_queue_size):
+        self.name = name
+        self.websocket = websocket
+        self.channels = set()
+        self.conversations = {}
+        self.outbox = asyncio.Queue(maxsize=send_queue_size)
+        self.reply_task = None
+        self.closing = False
+        self.writer_task = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self):
+        while True:
+            message = await self.outbox.get()
+            try:
+                await self.websocket.send(message)
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+    def send(self, **message):
+        if self.closing:
+            return
+        try:
+            self.outbox.put_nowait(json.dumps(message, ensure_ascii=False))
+        except asyncio.QueueFull:
+            print(f"{self.name} is too far behind, disconnecting.")
+            self.closing = True
+            asyncio.create_task(self.websocket.close(1013, "too slow"))
+
+    def get_conversation(self, persona):
+        if persona not in self.conversations:
+            # Each typewriter keeps its own history with every persona, apart from the console's
+            self.conversations[persona] = Conversation(
+                persona, session_name=f"{self.name}.{persona}", session_namespace=config.get("server_sessions_namespace", "server")
+            )
+        return self.conversations[persona]
+
+    async def close(self):
+        if self.reply_task is not None:
+            self.reply_task.cancel()
+        self.writer_task.cancel()
+
+
+class ChatServer:
+    """Websocket chat server for several typewriters at once.
+
+    Clients introduce themselves with a hello, join channels to receive what others type
+    there, and can chat with their own personas, whose replies are streamed back to them
+    token by token. Messages are JSON objects with a "type":
+
+        hello {name}                        -> welcome
+        join / leave {channel}
+        say {channel, text}                 -> message {channel, from, text} to the other members
+        chat {text, persona="assistant"}    -> token {id, text} ..., then done {id, text}
+
+    Any other fields of a say are passed along untouched, e.g. a timestamp for measuring latency.
+    """
+
+    def __init__(self, model=config["chat_model"], temperature=config["chat_temperature"], max_tokens=config["max_tokens"]):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.clients = {}   # name -> Client
+        self.channels = {}  # channel -> set of Clients
+        self.messages_in = 0
+        self.messages_out = 0
+
+    async def handler(self, websocket):
+        try:
+            hello = json.loads(await websocket.recv())
+        except (ValueError, websockets.exceptions.ConnectionClosed):
+            return
+        name = hello.get("name")
+        if hello.get("type") != "hello" or not name or name in self.clients:
+            await websocket.send(json.dumps({"type": "error", "text": "Say hello with a name that isn't taken."}))
+            return
+
+        client = Client(name, websocket, config.get("server_send_queue", 256))
+        self.clients[name] = client
+        client.send(type="welcome", name=name)
+        print(f"{name} connected, {len(self.clients)} clients.")
+        try:
+            async for raw in websocket:
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    client.send(type="error", text="Messages must be JSON.")
+                    continue
+                self.messages_in += 1
+                try:
+                    self.dispatch(client, message)
+                except KeyError as e:
+                    client.send(type="error", text=f"Missing field: {e}")
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for channel in list(client.channels):
+                self.leave(client, channel)
+            del self.clients[name]
+            await client.close()
+            print(f"{name} disconnected, {len(self.clients)} clients.")
+
+    def dispatch(self, client, message):
+        kind = message.get("type")
+        if kind == "join":
+            client.channels.add(message["channel"])
+            self.channels.setdefault(message["channel"], set()).add(client)
+        elif kind == "leave":
+            self.leave(client, message["channel"])
+        elif kind == "say":
+            self.fan_out(client, message)
+        elif kind == "chat":
+            # A new message to the personas replaces the reply in flight, like a barge-in
+            previous = client.reply_task
+            if previous is not None and not previous.done():
+                previous.cancel()
+            client.reply_task = asyncio.create_task(self.try_reply(client, message, previous))
+        else:
+            client.send(type="error", text=f"Unknown message type: {kind}")
+
+    def leave(self, client, channel):
+        client.channels.discard(channel)
+        members = self.channels.get(channel)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.channels[channel]
+
+    def fan_out(self, sender, message):
+        outgoing = {**message, "type": "message", "from": sender.name}
+        for member in self.channels.get(message["channel"], ()):
+            if member is not sender:
+                member.send(**outgoing)
+                self.messages_out += 1
+
+    async def try_reply(self, client, message, previous=None):
+        if previous is not None:
+            # Let the cancelled reply record what it got before this one touches the conversation
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            await self.reply(client, message)
+        except Exception as e:
+            print(f"Reply to {client.name} failed: {e}")
+            client.send(type="error", id=message.get("id"), text=str(e))
+
+    async def reply(self, client, message):
+        """Stream a persona's reply to a chat message back to the client that sent it."""
+        conversation = client.get_conversation(message.get("persona", "assistant"))
+        reply_id = message.get("id")
+        text = message.get("text", "").strip()
+        if text == "clear":
+            conversation.clear_conversation()
+            client.send(type="done", id=reply_id, text="")
+            return
+        elif text == "undo":
+            conversation.undo()
+            client.send(type="done", id=reply_id, text="")
+            return
+        elif not text:
+            return
+
+        conversation.add_message('user', text)
+        start = time.perf_counter()
+        first_token_time = None
+        usage = None
+        reply = ""
+        response = None
+        try:
+            response = await aclient.chat.completions.create(
+                model=self.model,
+                messages=image_store.materialize(conversation.get_window(self.model, self.max_tokens)),
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in response:
+                if not chunk.choices:
+                    # The last chunk has no choices, only the usage of the whole request
+                    usage = chunk.usage
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content is None:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                reply += delta.content
+                client.send(type="token", id=reply_id, text=delta.content)
+        except BaseException:
+            # Cancelled or failed: keep what arrived, or drop the prompt so the history stays in pairs
+            if response is not None:
+                await response.close()
+            if reply:
+                conversation.add_message('assistant', reply)
+            else:
+                conversation.pop_message()
+            raise
+        conversation.add_message('assistant', reply)
+        client.send(type="done", id=reply_id, text=reply)
+
+        end = time.perf_counter()
+        call_trace.record(
+            "server.chat",
+            self.model,
+            end - start,
+            ttft=(first_token_time or end) - start,
+            prompt_tokens=usage.prompt_tokens if usage is not None else None,
+            completion_tokens=usage.completion_tokens if usage is not None else None
+        )
+
+    async def report(self, interval_s):
+        """Print the message rates every interval_s seconds."""
+        last_in, last_out = 0, 0
+        while True:
+            await asyncio.sleep(interval_s)
+            print(
+                f"{len(self.clients)} clients, {len(self.channels)} channels, "
+                f"{(self.messages_in - last_in) / interval_s:.1f} msg/s in, {(self.messages_out - last_out) / interval_s:.1f} msg/s out"
+            )
+            last_in, last_out = self.messages_in, self.messages_out
+
+
+###### Functions ######
+
+async def serve(host, port, report_interval_s=0):
+    server = ChatServer()
+    async with websockets.serve(server.handler, host, port):
+        print(f"Chat server listening on ws://{host}:{port}")
+        if report_interval_s:
+            await server.report(report_interval_s)
+        else:
+            await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server for connected typewriters.")
+    parser.add_argument("--host", default=config.get("server_host", "0.0.0.0"), help="address to listen on")
+    parser.add_argument("--port", type=int, default=config.get("server_port", 8765), help="port to listen on")
+    parser.add_argument("--report", type=float, default=0, help="print message rates every this many seconds")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.report))
+
+
+if __name__ == "__main__":
+    main()
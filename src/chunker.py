@@ -0,0 +1,144 @@
+###### Standard Imports ######
+import time
+
+###### Global Vars ######
+SENTENCE = "sentence"
+CLAUSE = "clause"
+
+SENTENCE_ENDINGS = frozenset(".?!")
+CLAUSE_ENDINGS = frozenset(".?!,;:—)]}")
+# Closing quotes and brackets may trail the punctuation that ends a sentence, e.g. 'he said."'
+CLOSERS = frozenset("\"')]}”’")
+
+
+###### Classes ######
+
+class ChunkPolicy:
+    """Where a streamed reply may be split into chunks.
+
+    Args:
+        boundary (str): SENTENCE splits after . ? and !, CLAUSE also splits after , ; : — and closing brackets
+        max_chars (int, optional): Split at the last space once a chunk grows past this many characters
+        max_wait_ms (float, optional): Split at the last space once a chunk has been building for this long
+        min_chars (int, optional): Don't split at a boundary until the chunk has at least this many characters
+    """
+
+    def __init__(self, boundary=CLAUSE, max_chars=None, max_wait_ms=None, min_chars=0):
+        if boundary not in (SENTENCE, CLAUSE):
+            raise ValueError(f"Unknown chunk boundary: {boundary}")
+        self.boundary = boundary
+        self.max_chars = max_chars
+        self.max_wait_ms = max_wait_ms
+        self.min_chars = min_chars
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            boundary=config.get("chunk_boundary", CLAUSE),
+            max_chars=config.get("chunk_max_chars"),
+            max_wait_ms=config.get("chunk_max_wait_ms"),
+            min_chars=config.get("chunk_min_chars", 0),
+        )
+
+
+class TextChunker:
+    """Incremental chunker for streamed text.
+
+    Text is fed in as it arrives and only the new text is scanned, so the work done is linear
+    in the length of the reply. The pending chunk is kept as a list of pieces and only joined
+    when it is emitted. A chunk ends at the whitespace following a boundary, so chunks always
+    end in a space (which ElevenLabs expects) and joining them reproduces the input exactly.
+    """
+
+    # Scanner states
+    TEXT = 0
+    AFTER_BOUNDARY = 1  # Saw boundary punctuation, a following space confirms the split
+
+    def __init__(self, policy=None, clock=time.monotonic):
+        self.policy = policy or ChunkPolicy()
+        self.endings = SENTENCE_ENDINGS if self.policy.boundary == SENTENCE else CLAUSE_ENDINGS
+        self.clock = clock
+        self.parts = []
+        self.size = 0
+        self.last_space = -1  # Offset of the last whitespace in the pending chunk
+        self.started = None
+        self.state = self.TEXT
+
+    def _take(self, length):
+        """Remove and return the first `length` characters of the pending chunk."""
+        pending = "".join(self.parts)
+        chunk, rest = pending[:length], pending[length:]
+        self.parts = [rest] if rest else []
+        self.size = len(rest)
+        self.last_space = max(rest.rfind(" "), rest.rfind("\n"))
+        self.started = self.clock() if rest else None
+        return chunk
+
+    def feed(self, text):
+        """Add streamed text and return the list of chunks it completes."""
+        chunks = []
+        if not text:
+            return chunks
+
+        endings = self.endings
+        min_chars = self.policy.min_chars
+        segment_start = 0
+        for i, char in enumerate(text):
+            if char.isspace():
+                if self.state == self.AFTER_BOUNDARY and self.size + i - segment_start + 1 >= min_chars:
+                    self.parts.append(text[segment_start:i + 1])
+                    self.size += i + 1 - segment_start
+                    segment_start = i + 1
+                    chunks.append(self._take(self.size))
+                else:
+                    self.last_space = self.size + i - segment_start
+                self.state = self.TEXT
+            elif char in endings:
+                self.state = self.AFTER_BOUNDARY
+            elif not (self.state == self.AFTER_BOUNDARY and char in CLOSERS):
+                self.state = self.TEXT
+
+        if segment_start < len(text):
+            self.parts.append(text[segment_start:])
+            self.size += len(text) - segment_start
+            if self.started is None:
+                self.started = self.clock()
+
+        chunk = self._check_limits()
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _check_limits(self):
+        policy = self.policy
+        too_long = policy.max_chars is not None and self.size > policy.max_chars
+        too_slow = (
+            policy.max_wait_ms is not None
+            and self.started is not None
+            and (self.clock() - self.started) * 1000 >= policy.max_wait_ms
+        )
+        if (too_long or too_slow) and self.last_space >= 0:
+            return self._take(self.last_space + 1)
+        if too_long:
+            # No space to break at, so the whole oversized word goes out
+            return self._take(self.size)
+        return None
+
+    def flush(self):
+        """Return whatever is left once the stream has ended."""
+        chunk = self._take(self.size)
+        self.state = self.TEXT
+        return chunk
+
+
+###### Functions ######
+
+async def chunk_stream(texts, policy=None):
+    """Chunk an async iterator of streamed text. Time limits are checked as text arrives."""
+    chunker = TextChunker(policy)
+    async for text in texts:
+        for chunk in chunker.feed(text):
+            yield chunk
+    rest = chunker.flush()
+    if rest:
+        yield rest
@@ -0,0 +1,80 @@
+###### Local Imports ######
+from settings import config
+
+###### Global Vars ######
+IMAGE_TOKENS = 765      # A high detail 1024px image
+MESSAGE_OVERHEAD = 4    # Role and separators around each message
+_encodings = {}
+
+
+###### Functions ######
+
+def get_encoding(model):
+    if model not in _encodings:
+        import tiktoken  # Deferred so importing this module doesn't pay tiktoken's startup cost
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def strip_images(message):
+    """Return the message with its images replaced by a short note, or the message itself if it has none."""
+    content = message["content"]
+    if isinstance(content, str) or not any(part["type"] == "image_url" for part in content):
+        return message
+    texts = [part["text"] if part["type"] == "text" else "[image]" for part in content]
+    return {"role": message["role"], "content": " ".join(text for text in texts if text)}
+
+
+def count_tokens(message, model):
+    """Return (tokens as is, tokens with images stripped) for a message."""
+    encoding = get_encoding(model)
+    content = message["content"]
+    if isinstance(content, str):
+        tokens = MESSAGE_OVERHEAD + len(encoding.encode(content))
+        return tokens, tokens
+    images_count = sum(1 for part in content if part["type"] == "image_url")
+    stripped = MESSAGE_OVERHEAD + len(encoding.encode(strip_images(message)["content"]))
+    return stripped + images_count * IMAGE_TOKENS, stripped
+
+
+def get_budget(model):
+    budgets = config.get("context_token_budgets", {})
+    return budgets.get(model, budgets.get("default", 8000))
+
+
+def window_messages(messages, token_counts, budget, keep_image_turns=1):
+    """Fit a message history into a token budget.
+
+    The first message, the context prompt, is always kept. Then messages are taken from the
+    newest back for as long as they fit, and older ones are dropped. Only the newest
+    keep_image_turns messages with images keep them, if they fit or are the latest. Other messages
+    with images are sent with their text only.
+
+    Args:
+        messages (list): The full history, starting with the context prompt
+        token_counts (list): count_tokens() of each message
+        budget (int): Tokens available for the prompt
+    """
+    if not messages:
+        return []
+    remaining = budget - token_counts[0][0]
+    kept = []
+    images_kept = 0
+    for message, (tokens, stripped_tokens) in zip(reversed(messages[1:]), reversed(token_counts[1:])):
+        has_images = tokens != stripped_tokens
+        if has_images and images_kept < keep_image_turns and (tokens <= remaining or not kept):
+            images_kept += 1
+        else:
+            message, tokens = strip_images(message), stripped_tokens
+        if tokens > remaining and kept:
+            break
+        remaining -= tokens
+        kept.append(message)
+    kept.reverse()
+    # Don't open the window on a reply to a question that was dropped
+    if len(kept) > 1 and kept[0]["role"] == "assistant":
+        kept.pop(0)
+    return [messages[0]] + kept
@@ -0,0 +1,136 @@
+###### Local Imports ######
+import context_window
+import image_store
+import session_store
+import settings
+from settings import config
+from voices import voices
+
+
+###### Classes ######
+
+class Conversation:
+    """A chat persona's message history. The history is logged under session_name, which
+    defaults to the persona's name, and picked up from the log the next time it's used.
+    Conversations that aren't the console's own pass a session_namespace to keep their logs apart."""
+    
+    def __init__(self,
+                name,
+                voice_id=None,
+                initial_context=None,
+                session_name=None,
+                session_namespace=None
+    ):
+        self.name = name
+        if voice_id is None and name in voices.keys():
+            self.voice_id = voices[name]
+        else:
+            self.voice_id = voice_id
+            if voice_id not in voices.values():
+                print("Voice ID not found. Using default voice ID.")
+                self.voice_id = config["default_voice"]
+        
+        self.context = initial_context
+        self.messages = []
+        self.token_counts = []  # context_window.count_tokens() of each message, counted once
+        self.encoding = context_window.get_encoding(config["chat_model"]).name  # What token_counts were counted with
+        self.other_counts = {}  # encoding name -> token counts, for requests to models with another encoding
+        self.log = session_store.get_log(session_name or name, session_namespace)
+        if self.log is not None and self.log.exists():
+            self.replay()
+        else:
+            self.clear_conversation()
+        
+    def get_context(self):
+        if self.context is None:
+            try:
+                with open(f"./{settings.context_dir}/{self.name}_context.txt", "r") as f:
+                    self.context = f.read().strip()
+            except FileNotFoundError:
+                print(f"Context file for {self.name} not found. Using default context")
+                self.context = settings.default_context + " Your name is " + self.name + "."
+        return self.context
+    
+    def add_message(self, role, content):
+        message = {'role': role, 'content': content}
+        tokens = context_window.count_tokens(message, config["chat_model"])
+        self.messages.append(message)
+        self.token_counts.append(tokens)
+        if self.log is not None:
+            if not isinstance(content, str):
+                # The log outlives the in-memory image store, so its images have to be on disk
+                for part in content:
+                    if part["type"] == "image_url":
+                        image_store.store.persist(part["image_url"]["url"])
+            self.log.append({'event': 'message', 'message': message, 'tokens': tokens, 'encoding': self.encoding})
+    
+    def replay(self):
+        """Rebuild the history from the session log, counting tokens again only if the chat model's
+        encoding has changed since they were logged."""
+        print(f"Loading conversation with {self.name}...")
+        for event in self.log.events():
+            if event['event'] == 'message':
+                self.messages.append(event['message'])
+                if event.get('encoding') == self.encoding:
+                    self.token_counts.append(tuple(event['tokens']))
+                else:
+                    self.token_counts.append(context_window.count_tokens(event['message'], config["chat_model"]))
+            elif event['event'] == 'pop':
+                del self.messages[-1:]
+                del self.token_counts[-1:]
+            elif event['event'] == 'undo':
+                del self.messages[-2:]
+                del self.token_counts[-2:]
+            elif event['event'] == 'clear':
+                self.messages = []
+                self.token_counts = []
+        if self.messages:
+            self.context = self.messages[0]['content']
+        
+    def get_messages(self):
+        return self.messages
+    
+    def get_window(self, model, max_tokens):
+        """The messages to send with a request: the context prompt, and as many of the latest
+        turns as fit in the model's token budget with room left for the reply."""
+        budget = context_window.get_budget(model) - max_tokens
+        return context_window.window_messages(
+            self.messages, self.get_token_counts(model), budget, config.get("keep_image_turns", 1)
+        )
+    
+    def get_token_counts(self, model):
+        """Token counts of the messages in the model's encoding. For a model that doesn't share
+        the chat model's encoding they are counted on first use and kept up to date from there."""
+        encoding = context_window.get_encoding(model).name
+        if encoding == self.encoding:
+            return self.token_counts
+        counts = self.other_counts.setdefault(encoding, [])
+        for message in self.messages[len(counts):]:
+            counts.append(context_window.count_tokens(message, model))
+        return counts
+    
+    def clear_conversation(self):
+        print(f"Resetting conversation with {self.name}...")
+        self.messages = []
+        self.token_counts = []
+        self.other_counts = {}
+        if self.log is not None:
+            self.log.append({'event': 'clear'})
+        self.add_message('user', self.get_context())
+    
+    def pop_message(self):
+        """Remove the latest message, e.g. a prompt whose reply was cancelled before any of it arrived."""
+        self.messages.pop()
+        self.token_counts.pop()
+        self.other_counts = {}
+        if self.log is not None:
+            self.log.append({'event': 'pop'})
+    
+    def undo(self):
+        print("Undoing last message...")
+        # Remove the last assistant and user messages
+        del self.messages[-2:]
+        del self.token_counts[-2:]
+        self.other_counts = {}
+        if self.log is not None:
+            self.log.append({'event': 'undo'})
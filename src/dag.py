@@ -0,0 +1,79 @@
+###### Standard Imports ######
+import asyncio
+
+
+###### Classes ######
+
+class Stage:
+    """A named unit of async work that may only start once all of its dependencies have finished."""
+
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, deps={list(self.deps)})"
+
+
+###### Functions ######
+
+def check_stages(stages):
+    """Raise a ValueError if a stage name is duplicated, a dependency is unknown, or the graph has a cycle."""
+
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError(f"Duplicate stage name: {stage.name}")
+        by_name[stage.name] = stage
+
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+
+    visiting = set()
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle detected at stage {name}")
+        visiting.add(name)
+        for dep in by_name[name].deps:
+            visit(dep)
+        visiting.remove(name)
+        visited.add(name)
+
+    for stage in stages:
+        visit(stage.name)
+
+
+async def run_stages(stages):
+    """Run every stage as soon as its dependencies are done, overlapping independent stages.
+
+    Args:
+        stages (list[Stage]): The stages making up the graph
+    Returns:
+        dict: The return value of each stage, keyed by stage name
+    """
+    check_stages(stages)
+    tasks = {}
+
+    async def run(stage):
+        # Dependencies are looked up at run time, so every task exists before any of them starts
+        await asyncio.gather(*(tasks[dep] for dep in stage.deps))
+        return await stage.fn()
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.create_task(run(stage), name=stage.name)
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    return {name: task.result() for name, task in tasks.items()}
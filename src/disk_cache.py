@@ -0,0 +1,92 @@
+###### Standard Imports ######
+import os
+import threading
+import time
+
+
+###### Classes ######
+
+class DiskCache:
+    """Size-bounded on-disk key/value store with least recently used eviction.
+
+    Each entry is one file named after its key. Reads touch the file's modification time, and
+    once the directory grows past max_bytes the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes, extension=".bin"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.index = None  # key -> [size, last_used], built on first use
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}{self.extension}")
+
+    def _load_index(self):
+        if self.index is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index = {}
+        self.total_bytes = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.extension):
+                    stat = entry.stat()
+                    self.index[entry.name[:-len(self.extension)]] = [stat.st_size, stat.st_mtime]
+                    self.total_bytes += stat.st_size
+
+    def contains(self, key):
+        with self.lock:
+            self._load_index()
+            return key in self.index
+
+    def get_bytes(self, key):
+        """Return the stored bytes for key, or None if there aren't any."""
+        with self.lock:
+            self._load_index()
+            if key not in self.index:
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "rb") as file:
+                    data = file.read()
+            except OSError:
+                # Removed behind our back
+                self._forget(key)
+                return None
+            now = time.time()
+            self.index[key][1] = now
+            os.utime(path, (now, now))
+            return data
+
+    def put_bytes(self, key, data):
+        with self.lock:
+            self._load_index()
+            path = self._path(key)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+            if key in self.index:
+                self.total_bytes -= self.index[key][0]
+            self.index[key] = [len(data), time.time()]
+            self.total_bytes += len(data)
+            self._evict()
+
+    def _forget(self, key):
+        size, _ = self.index.pop(key)
+        self.total_bytes -= size
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in sorted(self.index, key=lambda k: self.index[k][1]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self._forget(key)
@@ -1,33 +1,84 @@
 ###### Standard Imports ######
-import yaml
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+import weakref
 
 ###### Third-Party Imports ######
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 ###### Local Imports ######
 from bias import get_bias
 import settings
 from settings import config
 import images
+import image_store
+from rate_limit import TokenBudget
+import response_cache
+from response_cache import CacheMiss
+import call_trace
 
 ###### Global Vars ######
-client = OpenAI(api_key=settings.OPENAI_API_KEY)
+# chat_base_url may point at a local OpenAI compatible stand-in instead of the OpenAI API
+client = OpenAI(api_key=settings.OPENAI_API_KEY, base_url=config.get("chat_base_url"))
+_aclients = weakref.WeakKeyDictionary()  # event loop -> AsyncOpenAI
+token_budget = None
 
 
-def get_synchonous_response(
-    prompt=None,
-    messages=None,
-    model=config["chat_model"],
-    max_tokens=config["max_tokens"],
-    temperature=config["chat_temperature"],
-    image_url=None,
-    image_name=None,
-    logit_bias={}
-):
-    
+def get_aclient():
+    """Return the AsyncOpenAI client for the running event loop. Its connection pool is bound to
+    the loop it was first used on, so each asyncio.run gets a client of its own."""
+    loop = asyncio.get_running_loop()
+    if loop not in _aclients:
+        _aclients[loop] = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, base_url=config.get("chat_base_url"))
+    return _aclients[loop]
+
+
+def run_sync(coroutine):
+    """Run a coroutine to completion for a synchronous caller. Inside a running event loop it runs
+    on a loop of its own in a worker thread, blocking the caller as the sync client would."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def set_token_budget(tokens_per_minute):
+    """Limit the token throughput of get_async_response. Pass None to remove the limit."""
+    global token_budget
+    token_budget = TokenBudget(tokens_per_minute) if tokens_per_minute else None
+
+
+def estimate_tokens(messages, max_tokens):
+    """Cheap upper-bound guess at a request's token usage, used to reserve rate limit budget."""
+    chars = 0
+    images_count = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part["type"] == "image_url":
+                images_count += 1
+            else:
+                chars += len(part.get("text", ""))
+    # Roughly four characters per token, a high detail 1024px image is 765 tokens,
+    # plus the worst case for the completion
+    return chars // 4 + images_count * 765 + max_tokens
+
+
+def build_messages(prompt=None, messages=None, image_url=None, image_name=None):
+    """Assemble the message list for a request. Returns None if there is no content."""
+
+    # Messages hold image store references, which are only swapped for the data URLs when sending
     if image_name is not None:
-        image_url = images.get_base64_image_url(image_name)
-    
+        image_url = images.get_image_ref(image_name)
+    elif image_url is not None:
+        image_url = image_store.store.intern(image_url)
+
     if messages is None:
         content = []
         if image_url is not None:
@@ -36,18 +87,134 @@ def get_synchonous_response(
             content.append({"type": "text", "text": prompt})
         if len(content) == 0:
             print('No content provided for GPT request.')
-            return ""
+            return None
         messages = [{"role": "user", "content": content}]
-    
-    
-    
+    return messages
+
+
+def get_cached_response(key, use_cache):
+    """Look up a recorded response. In replay mode a missing entry is an error, and the
+    use_cache opt-out is ignored since there is nothing else to answer from."""
+    cache = response_cache.cache
+    if cache.mode == response_cache.REPLAY:
+        entry = cache.get(key)
+        if entry is None:
+            raise CacheMiss(f"No recorded response for request {key}")
+        return entry
+    if use_cache:
+        return cache.get(key)
+    return None
+
+
+def cache_response(key, response):
+    # Responses are stored even when the lookup was skipped, so replay mode can serve them later
+    usage = response.usage.model_dump() if response.usage is not None else None
+    response_cache.cache.put(key, {
+        "model": response.model,
+        "content": response.choices[0].message.content,
+        "usage": usage,
+    })
+
+
+def trace_response(stage, response, latency):
+    usage = response.usage
+    call_trace.record(
+        stage,
+        response.model,
+        latency,
+        prompt_tokens=usage.prompt_tokens if usage is not None else None,
+        completion_tokens=usage.completion_tokens if usage is not None else None,
+    )
+
+
+def get_synchonous_response(
+    prompt=None,
+    messages=None,
+    model=config["chat_model"],
+    max_tokens=config["max_tokens"],
+    temperature=config["chat_temperature"],
+    image_url=None,
+    image_name=None,
+    logit_bias={},
+    use_cache=True,
+    stage=None
+):
+    """Send a chat completion request and return the response text. Identical requests are
+    answered from the response cache; pass use_cache=False for stages that should produce a
+    fresh response every time. The stage name labels the call in the trace log."""
+
+    messages = build_messages(prompt, messages, image_url, image_name)
+    if messages is None:
+        return ""
+
+    start = time.perf_counter()
+    key = response_cache.ResponseCache.make_key(model, messages, temperature, max_tokens, logit_bias)
+    entry = get_cached_response(key, use_cache)
+    if entry is not None:
+        call_trace.record(stage, model, time.perf_counter() - start, cache_hit=True)
+        return entry["content"]
+
     response = client.chat.completions.create(
         model=model,
-        messages=messages,
+        messages=image_store.materialize(messages),
         max_tokens=max_tokens,
         temperature=temperature,
         logit_bias=logit_bias
     )
-    with open('response.yaml', 'w') as file:
-        yaml.dump(response, file)
+    trace_response(stage, response, time.perf_counter() - start)
+    cache_response(key, response)
+    return response.choices[0].message.content
+
+
+async def get_async_response(
+    prompt=None,
+    messages=None,
+    model=config["chat_model"],
+    max_tokens=config["max_tokens"],
+    temperature=config["chat_temperature"],
+    image_url=None,
+    image_name=None,
+    logit_bias={},
+    use_cache=True,
+    stage=None
+):
+    """Same as get_synchonous_response, but awaits the request on the AsyncOpenAI client
+    so that independent requests can run concurrently on one event loop."""
+
+    messages = build_messages(prompt, messages, image_url, image_name)
+    if messages is None:
+        return ""
+
+    start = time.perf_counter()
+    key = response_cache.ResponseCache.make_key(model, messages, temperature, max_tokens, logit_bias)
+    entry = get_cached_response(key, use_cache)
+    if entry is not None:
+        call_trace.record(stage, model, time.perf_counter() - start, cache_hit=True)
+        return entry["content"]
+
+    budget = token_budget
+    reserved = 0
+    if budget is not None:
+        reserved = await budget.acquire(estimate_tokens(messages, max_tokens))
+        # The wait for budget isn't the API's latency
+        start = time.perf_counter()
+
+    try:
+        response = await get_aclient().chat.completions.create(
+            model=model,
+            messages=image_store.materialize(messages),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            logit_bias=logit_bias
+        )
+    except BaseException:
+        if budget is not None:
+            budget.settle(reserved, 0)
+        raise
+
+    if budget is not None:
+        used = response.usage.total_tokens if response.usage is not None else reserved
+        budget.settle(reserved, used)
+    trace_response(stage, response, time.perf_counter() - start)
+    cache_response(key, response)
     return response.choices[0].message.content
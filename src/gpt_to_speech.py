@@ -4,11 +4,12 @@ import json
 import threading
 import queue
 import base64
+import time
 
 ###### Third-Party Imports ######
 from openai import AsyncOpenAI
 import xi_labs
-from xi_labs import voices
+import audio
 from PIL import Image
 
 ###### Local Imports ######
@@ -17,6 +18,14 @@ from bias import get_bias
 import settings
 from settings import config
 import images
+import image_store
+import call_trace
+from chunker import ChunkPolicy, chunk_stream
+import latency
+from conversation import Conversation
+from voices import voices
+import session_store
+from wake_words import WakeWordMatcher, PartialWakeDetector
 
 ###### Global Vars ######
 
@@ -26,95 +35,16 @@ aclient = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
 conversations = {}
 current_conversation = None
 wake_word_queue = queue.Queue()
-
-
-###### Classes ######
-
-class Conversation:
-    
-    def __init__(self,
-                name,
-                voice_id=None,
-                initial_context=None
-    ):
-        self.name = name
-        if voice_id is None and name in voices.keys():
-            self.voice_id = voices[name]
-        else:
-            self.voice_id = voice_id
-            if voice_id not in voices.values():
-                print("Voice ID not found. Using default voice ID.")
-                self.voice_id = config["default_voice"]
-        
-        self.context = initial_context
-        self.messages = []
-        self.clear_conversation()
-        
-    def get_context(self):
-        if self.context is None:
-            try:
-                with open(f"./{settings.context_dir}/{self.name}_context.txt", "r") as f:
-                    self.context = f.read().strip()
-            except FileNotFoundError:
-                print(f"Context file for {self.name} not found. Using default context")
-                self.context = settings.default_context + " Your name is " + self.name + "."
-        return self.context
-    
-    def add_message(self, role, content):
-        self.messages.append({'role': role, 'content': content})
-        
-    def get_messages(self):
-        return self.messages
-    
-    def clear_conversation(self):
-        print(f"Resetting conversation with {self.name}...")
-        self.messages = []
-        self.messages.append({'role': 'user', 'content': self.get_context()})
-    
-    def undo(self):
-        print("Undoing last message...")
-        # Remove the last assistant and user messages
-        self.messages.pop()
-        self.messages.pop()
-        
-    def activate(self):
-        print(f"Activating conversation with {self.name}...")
-        wake_word_queue.put(self.name)
+current_turn = None  # Task answering the latest voice prompt
+chunk_policy = ChunkPolicy.from_config(config)
 
 
 ###### Functions ######
 
 async def text_chunker(chunks):
-
-    buffer = ''  # Initialize the sentence as an empty string
-    async for text in chunks:
-        
-        # Strip any leading space to avoid unwanted spaces before punctuation
-        starts_with_space = text.startswith(' ')
-        text = text.lstrip()
-        try:
-            if text.startswith(' " '):
-                text = ' "' + text[3:]
-            if buffer.endswith(' "') and text[0].isalpha():
-                buffer += text
-            elif buffer and (buffer == '' or buffer == ' ' or (not starts_with_space and buffer[-1].isalpha() and text[0].isalpha())):
-                buffer += text
-            elif buffer and not buffer.endswith(' ') and (not text.startswith((' ', "'", '"', ',', '.', '?', '!', ';', ':', '—', '-', '(', ')', '[', ']', '}')) or starts_with_space):
-                # If the sentence does not end with a space and the element does not start with a punctuation or space,
-                # add a space before the element
-                buffer += ' ' + text
-            else:
-                # Otherwise, append the element directly to the sentence
-                buffer += text
-        except IndexError:
-            buffer += text
-        
-        if buffer.endswith(('.', '?', '!', ';', ':', '—', '-', '(', ')', '[', ']', '}', " ")):
-            yield buffer
-            buffer = ' '
-
-    if buffer:
-        yield buffer.strip()
+    """Split the streamed reply into speakable chunks, according to the chunk policy in the config file."""
+    async for chunk in chunk_stream(chunks, chunk_policy):
+        yield chunk
 
 
 async def chat_completion(
@@ -136,86 +66,199 @@ async def chat_completion(
         max_tokens (int, optional): The maximum number of tokens to be generated. Defaults to config["max_tokens"].
     Yields:
         _type_: _description_
+    
+    The reply is added to the conversation once it has been played or printed. If the task is
+    cancelled part way through, e.g. by a barge-in, the completion stream is closed and only
+    the chunks that had started playing, or had been printed, are kept in the conversation.
+    If there were none, the user's prompt is removed as well.
     """
-    response = await aclient.chat.completions.create(
-        model=model,
-        messages=conversation.get_messages(),
-        temperature=temperature,
-        stream=True,
-        max_tokens=max_tokens,
-        logit_bias=logit_bias
-    )
+    timer = latency.TurnTimer()
+    if config["chat_output_mode"] == "voice":
+        # Open the ElevenLabs websocket while the completion request is in flight
+        xi_labs.prewarm(conversation.voice_id)
+    start = time.perf_counter()
+    timer.mark("request_sent")
+    response = None
+    
+    reply = ""
+    generated = False
+    delivered = []  # Chunks that have been played or printed
     
     async def text_iterator():
         
-        this_message = ""
+        nonlocal reply, generated
+        first_token_time = None
+        usage = None
+        # Token arrival times can be recorded for replay by bench_chunker.py
+        recorded_tokens = [] if config.get("token_stream_log") else None
         async for chunk in response:
+            if not chunk.choices:
+                # The last chunk has no choices, only the usage of the whole request
+                usage = chunk.usage
+                continue
             delta = chunk.choices[0].delta
             if delta.content is not None:
-                this_message += delta.content
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                    timer.mark("first_token")
+                reply += delta.content
+                if recorded_tokens is not None:
+                    recorded_tokens.append([delta.content, round((time.perf_counter() - start) * 1000, 1)])
                 yield delta.content
             else:
                 continue
-        conversation.add_message('assistant', this_message) # Update conversation history
+        generated = True
+        
+        if recorded_tokens is not None:
+            with open(config["token_stream_log"], "a", encoding="utf-8") as file:
+                file.write(json.dumps({"model": model, "tokens": recorded_tokens}) + "\n")
+        
+        end = time.perf_counter()
+        call_trace.record(
+            "chat",
+            model,
+            end - start,
+            ttft=(first_token_time or end) - start,
+            prompt_tokens=usage.prompt_tokens if usage is not None else None,
+            completion_tokens=usage.completion_tokens if usage is not None else None
+        )
 
-    if config["chat_output_mode"] == "voice":
-        await xi_labs.text_to_speech_input_streaming(text_iterator(), text_chunker, conversation.voice_id)
-    else:
-        last_output = ""
-        async for chunk in text_chunker(text_iterator()):
-            print(chunk, end="", sep="", flush=True)
-            last_output += chunk
-        print("\n")
-        return last_output
+    try:
+        response = await aclient.chat.completions.create(
+            model=model,
+            messages=image_store.materialize(conversation.get_window(model, max_tokens)),
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            max_tokens=max_tokens,
+            logit_bias=logit_bias
+        )
+        if config["chat_output_mode"] == "voice":
+            await xi_labs.text_to_speech_input_streaming(
+                text_iterator(), text_chunker, conversation.voice_id, timer=timer, heard=delivered
+            )
+            conversation.add_message('assistant', reply)
+            latency.session.add(timer)
+            if config.get("print_latency", False):
+                print(timer.waterfall())
+        else:
+            async for chunk in text_chunker(text_iterator()):
+                print(chunk, end="", sep="", flush=True)
+                delivered.append(chunk)
+            print("\n")
+            conversation.add_message('assistant', reply)
+            return reply
+    except asyncio.CancelledError:
+        if response is not None and not generated:
+            # Stop the generation, so no more tokens are paid for
+            await response.close()
+        if delivered:
+            conversation.add_message('assistant', "".join(delivered))
+        else:
+            # Nothing was said, so drop the prompt too and keep the history in pairs
+            conversation.pop_message()
+        raise
+
+
+async def cancel_turn():
+    """Cancel the reply in flight, if any, and wait until it has stopped."""
+    global current_turn
+    turn, current_turn = current_turn, None
+    if turn is None:
+        return
+    if not turn.done():
+        print("Interrupted.")
+        turn.cancel()
+    try:
+        await turn
+    except asyncio.CancelledError:
+        if not turn.cancelled():
+            # It is this task that is being cancelled
+            raise
 
 
-def transcript_parser_task(transcript_queue, prompt_queue, terminate_flag):
+def interrupt_turn():
+    """Start cancelling the reply in flight without waiting for it, for when the user starts speaking."""
+    if current_turn is not None and not current_turn.done():
+        print("Interrupted.")
+        current_turn.cancel()
+
+
+def select_wake_word(word, current_wake_word):
+    """Switch to the persona named by a wake word, unless it is already current or the override word.
+    Returns the wake word of the current persona."""
+    if word in (current_wake_word, config["override_wake_word"]):
+        return current_wake_word
+    print("Wake word:", word)
+    # Conversations started with "talk to" keep the name as typed
+    name = next((name for name in conversations if name.lower() == word), word)
+    switch_conversation(name)
+    return word
+
+
+async def transcript_parser(transcript_queue, prompt_queue):
     """Parses the real-time voice input transcript to identify the wake word,
-    and extracts the prompt to be sent to the chatbot. This function is meant
-    to be run in a separate thread.
+    and extracts the prompt to be sent to the chatbot. This coroutine runs on
+    the event loop until it is cancelled, and sleeps while there is no speech.
+    
+    Any conversation name, voice name or the override word is a wake word. Wake words
+    are looked for in the partial transcripts, so a persona switch happens while the
+    user is still speaking, and the final transcript only supplies the prompt.
 
     Args:
-        transcript_queue (_type_): Queue holding contents of the audio listener transcript
-        prompt_queue (_type_): Queue holding the prompts to be sent to the chatbot
-        terminate_flag (_type_): Flag to signal the termination of the parser thread
+        transcript_queue (listener.AsyncTranscriptQueue): Queue of transcript events from the audio listener
+        prompt_queue (asyncio.Queue): Queue holding the prompts to be sent to the chatbot
     """
     
     current_wake_word = config["override_wake_word"]
-    override_wake_word = config["override_wake_word"]
+    matcher = WakeWordMatcher([
+        config["override_wake_word"], *voices.keys(), *conversations.keys(), *session_store.list_sessions()
+    ])
+    detector = PartialWakeDetector(matcher, config.get("wake_word_stable_partials", 2))
     
-    # This is a task that runs in a loop within a separate thread
     while True:
+        
+        # Get the next transcript event
+        event = await transcript_queue.get()
     
         # Check if the wake word has been changed
-        if not wake_word_queue.empty():
-            current_wake_word = wake_word_queue.get()  
-            
-        # Get the current transcript from the queue
-        transcript, status = transcript_queue.get()
-        transcript = json.loads(transcript)
+        while not wake_word_queue.empty():
+            current_wake_word = wake_word_queue.get().lower()
+            matcher.update([current_wake_word])
         
-        if status == "final":
+        if event.kind == listener.TranscriptEvent.FINAL:
+            text = event.text
             # Print the finalized voice input for debugging purposes
-            print("F:", transcript['text'])
+            print("F:", text)
             
-            # Check for the presence of the wake word in the transcript, and if found, extract the prompt
+            # Check for the presence of a wake word in the transcript, and if found, extract the prompt
             if config["use_wake_word"]:
-                if current_wake_word in transcript['text'].lower():
-                    prompt = transcript['text'][transcript['text'].lower().index(current_wake_word) + len(current_wake_word):].strip()
+                match = matcher.search(text)
+                if match is not None:
+                    word, prompt_start = match
+                    prompt = text[prompt_start:].strip()
+                elif detector.fired is not None:
+                    # The recognizer revised the wake word away in the final result
+                    word, prompt = detector.fired, text.strip()
+                else:
+                    word = None
+                detector.reset()
+                if word is not None:
+                    current_wake_word = select_wake_word(word, current_wake_word)
                     print("Text after wake word:", prompt)
-                    prompt_queue.put(prompt)
-                elif override_wake_word is not None and override_wake_word in transcript['text'].lower():
-                    prompt = transcript['text'][transcript['text'].lower().index(override_wake_word) + len(override_wake_word):].strip()
-                    print("Text after override wake word:", prompt)
-                    prompt_queue.put(prompt)
-            elif transcript['text'] is not None and transcript['text'].strip() != "":
-                prompt_queue.put(transcript['text'])
+                    prompt_queue.put_nowait(prompt)
+            elif text is not None and text.strip() != "":
+                prompt_queue.put_nowait(text)
                 
-        elif status == "partial":
+        elif event.kind == listener.TranscriptEvent.PARTIAL:
             # Print the partial transcript for debugging purposes
-            print("P:", transcript['partial'], end="\r")
-        if terminate_flag.is_set():
-            break
+            print("P:", event.text, end="\r")
+            if config["use_wake_word"]:
+                word = detector.feed(event.text)
+                if word is not None:
+                    if config.get("barge_in", False):
+                        interrupt_turn()
+                    current_wake_word = select_wake_word(word, current_wake_word)
 
 
 async def handle_text_in():
@@ -234,40 +277,50 @@ async def handle_text_in():
 
 async def handle_voice_in():
     
-    transcript_queue = queue.Queue()
-    prompt_queue = queue.Queue()
+    global current_turn
+    
+    # The listener runs in its own thread since it blocks on the microphone, and hands
+    # its events to the loop. Everything else happens on the loop.
+    transcript_queue = listener.AsyncTranscriptQueue(asyncio.get_running_loop(), config.get("transcript_queue_size", 32))
+    prompt_queue = asyncio.Queue()
         
     terminate_flag = threading.Event()
-    listener_thread = threading.Thread(target=listener.run, args=(transcript_queue, terminate_flag))
-    parser_thread = threading.Thread(
-        target=transcript_parser_task, 
+    listener_thread = threading.Thread(
+        target=listener.run,
         args=(
-            transcript_queue, 
-            prompt_queue, 
-            terminate_flag
-    ))            
+            transcript_queue,
+            terminate_flag,
+            config.get("partial_rate_hz", 4),
+            config.get("use_vad", False),
+            config.get("vad_options")
+        )
+    )
     listener_thread.start()
-    parser_thread.start()
+    parser_task = asyncio.create_task(transcript_parser(transcript_queue, prompt_queue))
     
     try:
         while True:
-            if prompt_queue.qsize() > 0:
-                print("Prompt queue size:", prompt_queue.qsize())
-                user_query:str = prompt_queue.get()
-                user_query = user_query.strip()
-                
-                if user_query.lower() == "exit":  # Provide a way to exit the loop
-                    print("Exiting...")
-                    terminate_flag.set()
-                    listener_thread.join()
-                    parser_thread.join()
-                    break
-                else:  
-                    await handle_input(user_query)
+            user_query:str = await prompt_queue.get()
+            user_query = user_query.strip()
+            
+            if config.get("barge_in", False):
+                # A new prompt replaces the reply in flight
+                await cancel_turn()
+            
+            if user_query.lower() == "exit":  # Provide a way to exit the loop
+                print("Exiting...")
+                break
+            elif config.get("barge_in", False):
+                # Answer in the background, so the next prompt can interrupt
+                current_turn = asyncio.create_task(handle_input(user_query))
+            else:  
+                await handle_input(user_query)
     finally:
+        await cancel_turn()
         terminate_flag.set()
-        listener_thread.join()
-        parser_thread.join()
+        parser_task.cancel()
+        # The listener checks the flag after each audio block
+        await asyncio.to_thread(listener_thread.join)
 
 
 async def handle_input(user_query:str):
@@ -293,9 +346,9 @@ async def handle_input(user_query:str):
         return
     elif user_query.startswith("image"):
         if user_query.startswith("image_local"):
-            url = images.get_base64_image_url(config["local_image_name"])
+            url = images.get_image_ref(config["local_image_name"])
         elif user_query.startswith("image_url: "):
-            url = user_query.split(" ")[1]
+            url = image_store.store.intern(user_query.split(" ")[1])
         else:
             print("Invalid image command. Please use 'image: ' or 'image_url: '")
             return
@@ -323,7 +376,11 @@ def switch_conversation(conversation_name):
         current_conversation = Conversation(conversation_name)
         conversations[conversation_name] = current_conversation
         
-    current_conversation.activate()
+    print(f"Activating conversation with {current_conversation.name}...")
+    wake_word_queue.put(current_conversation.name)
+    if config["chat_output_mode"] == "voice":
+        # The next reply is likely to be in this voice
+        xi_labs.prewarm(current_conversation.voice_id)
 
 
 async def main():
@@ -331,10 +388,20 @@ async def main():
     global current_conversation
     mode = config["chat_input_mode"]
     current_conversation = Conversation("assistant", voices["michael"])
-    if mode == "text":
-        await handle_text_in()
-    elif mode == "voice":
-        await handle_voice_in()
+    if config["chat_output_mode"] == "voice":
+        # Start the player now so the first reply doesn't pay for spawning it
+        await audio.player.start()
+    try:
+        if mode == "text":
+            await handle_text_in()
+        elif mode == "voice":
+            await handle_voice_in()
+    finally:
+        if config["chat_output_mode"] == "voice":
+            await xi_labs.pool.close()
+            await audio.player.close()
+            if config.get("print_latency", False):
+                print(latency.session.summary())
 
 
 # Main execution
@@ -0,0 +1,121 @@
+###### Standard Imports ######
+import collections
+import hashlib
+import threading
+
+###### Local Imports ######
+from disk_cache import DiskCache
+from settings import config
+
+###### Global Vars ######
+REF_PREFIX = "stored-image:"
+
+
+###### Classes ######
+
+class ImageStore:
+    """Content-addressed store of image data URLs, so message histories only hold a short reference.
+
+    Each URL is kept once, however many messages refer to it. The most recently used URLs stay in
+    memory up to max_memory_bytes, and the rest are spilled to disk and read back when needed.
+    """
+
+    def __init__(self, spill_dir, max_memory_bytes, max_disk_bytes):
+        self.max_memory_bytes = max_memory_bytes
+        self.memory = collections.OrderedDict()  # digest -> data URL, least recently used first
+        self.memory_bytes = 0
+        self.disk = DiskCache(spill_dir, max_disk_bytes, extension=".txt")
+        self.lock = threading.Lock()
+
+    def intern(self, url):
+        """Store a data URL and return its reference. Other URLs are returned as they are,
+        since the API fetches them itself."""
+        if not url.startswith("data:"):
+            return url
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        with self.lock:
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+            else:
+                self._remember(digest, url)
+        return REF_PREFIX + digest
+
+    def get(self, ref):
+        """Return the data URL for a reference."""
+        digest = ref[len(REF_PREFIX):]
+        with self.lock:
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                return self.memory[digest]
+        data = self.disk.get_bytes(digest)
+        if data is None:
+            raise KeyError(f"Image {digest} is no longer stored")
+        url = data.decode("utf-8")
+        with self.lock:
+            if digest not in self.memory:
+                self._remember(digest, url)
+        return url
+
+    def contains(self, ref):
+        """Whether the URL behind a reference is still in memory or on disk."""
+        digest = ref[len(REF_PREFIX):]
+        with self.lock:
+            if digest in self.memory:
+                return True
+        return self.disk.contains(digest)
+
+    def persist(self, ref):
+        """Write the URL behind a reference to disk now, for references kept beyond this process."""
+        if not is_ref(ref):
+            return
+        digest = ref[len(REF_PREFIX):]
+        with self.lock:
+            url = self.memory.get(digest)
+        if url is not None and not self.disk.contains(digest):
+            self.disk.put_bytes(digest, url.encode("utf-8"))
+
+    def _remember(self, digest, url):
+        self.memory[digest] = url
+        self.memory_bytes += len(url)
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            spilled_digest, spilled_url = self.memory.popitem(last=False)
+            self.memory_bytes -= len(spilled_url)
+            self.disk.put_bytes(spilled_digest, spilled_url.encode("utf-8"))
+
+
+###### Functions ######
+
+def is_ref(url):
+    return isinstance(url, str) and url.startswith(REF_PREFIX)
+
+
+def materialize(messages):
+    """Return the messages with image references replaced by their data URLs, ready to send.
+    Messages without references are passed through, not copied."""
+    materialized = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str) or not any(
+            part["type"] == "image_url" and is_ref(part["image_url"]["url"]) for part in content
+        ):
+            materialized.append(message)
+            continue
+        parts = []
+        for part in content:
+            if part["type"] == "image_url" and is_ref(part["image_url"]["url"]):
+                try:
+                    part = {**part, "image_url": {**part["image_url"], "url": store.get(part["image_url"]["url"])}}
+                except KeyError:
+                    # Evicted since an earlier session referred to it
+                    part = {"type": "text", "text": "[image]"}
+            parts.append(part)
+        materialized.append({**message, "content": parts})
+    return materialized
+
+
+###### Global Vars ######
+store = ImageStore(
+    config["image_store_dir"],
+    config["image_store_memory_mb"] * 1024 * 1024,
+    config["image_store_disk_mb"] * 1024 * 1024,
+)
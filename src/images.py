@@ -1,24 +1,109 @@
 from PIL import Image
 import base64
+import hashlib
+import io
 
 from settings import config
 import os
+import json
+import image_store
+from resizer import resize_image  # Kept as images.resize_image for older callers
 
-def resize_image(input_image_path, output_image_path, new_width):
-    with Image.open(input_image_path) as img:
-        original_width, original_height = img.size
-        if original_width <= new_width:
-            return
-        aspect_ratio = original_height / original_width
-        new_height = int(new_width * aspect_ratio)
-        resized_img = img.resize((new_width, new_height))
-        resized_img.save(output_image_path)
-        print(f"The image has been resized to {new_width}x{new_height}")
-
-def get_base64_image_url(image_name):
-    image_path = os.path.join(config["images_dir"], image_name)
-    resize_image(image_path, image_path, 1024)
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+# (content hash, width) -> image store reference
+_ref_cache = {}
+# path -> (modification time, size, content hash), so unchanged files aren't re-hashed
+_digest_cache = {}
+_manifest = None
+
+def get_file_digest(path):
+    stat = os.stat(path)
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    digest = digest.hexdigest()
+    _digest_cache[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+def encode_image(image_path, new_width):
+    """Return a data URL for the image, downscaled in memory to at most new_width pixels wide.
+    The source file is left untouched."""
     with open(image_path, "rb") as image_file:
-        base64_image =  base64.b64encode(image_file.read()).decode('utf-8')
-        url = f"data:image/jpeg;base64,{base64_image}"
-        return url
\ No newline at end of file
+        data = image_file.read()
+    with Image.open(io.BytesIO(data)) as img:
+        image_format = img.format
+        original_width, original_height = img.size
+        if original_width <= new_width and image_format in MIME_TYPES:
+            # Already small enough and in a format the API accepts, so send the original bytes
+            return f"data:{MIME_TYPES[image_format]};base64,{base64.b64encode(data).decode('utf-8')}"
+
+        if original_width > new_width:
+            new_height = int(new_width * original_height / original_width)
+            img = img.resize((new_width, new_height))
+        if image_format not in MIME_TYPES:
+            image_format = "PNG" if img.mode in ("RGBA", "LA", "P") else "JPEG"
+        if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format)
+    return f"data:{MIME_TYPES[image_format]};base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
+def get_manifest():
+    """Load the manifest written by preprocess_images.py, or an empty one if it hasn't been run."""
+    global _manifest
+    if _manifest is None:
+        manifest_path = os.path.join(config["derived_images_dir"], "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                _manifest = json.load(file)
+        else:
+            _manifest = {}
+    return _manifest
+
+def get_derived_image_path(image_name, new_width):
+    """Return the preprocessed copy of the image if there is an up to date one at this width."""
+    entry = get_manifest().get(image_name)
+    if entry is None or entry["target_width"] != new_width:
+        return None
+    try:
+        stat = os.stat(os.path.join(config["images_dir"], image_name))
+    except FileNotFoundError:
+        return None
+    if (stat.st_mtime_ns, stat.st_size) != (entry["source_mtime_ns"], entry["source_size"]):
+        return None
+    return os.path.join(config["derived_images_dir"], entry["file"])
+
+def get_image_ref(image_name, new_width=1024):
+    """Return an image store reference to the image's data URL, for use in messages.
+    See image_store.materialize for turning it back into the URL."""
+    image_path = get_derived_image_path(image_name, new_width) or os.path.join(config["images_dir"], image_name)
+    key = (get_file_digest(image_path), new_width)
+
+    # The store can have evicted the URL since, in which case it is interned again below
+    if key in _ref_cache and image_store.store.contains(_ref_cache[key]):
+        return _ref_cache[key]
+
+    cache_path = os.path.join(config["image_cache_dir"], f"{key[0]}_{new_width}.txt")
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as file:
+            url = file.read()
+    else:
+        url = encode_image(image_path, new_width)
+        os.makedirs(config["image_cache_dir"], exist_ok=True)
+        temp_path = cache_path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(url)
+        os.replace(temp_path, cache_path)
+
+    ref = image_store.store.intern(url)
+    _ref_cache[key] = ref
+    return ref
+
+def get_base64_image_url(image_name, new_width=1024):
+    return image_store.store.get(get_image_ref(image_name, new_width))
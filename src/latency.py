@@ -0,0 +1,81 @@
+###### Standard Imports ######
+import time
+
+###### Global Vars ######
+# The hops of a voice reply, in the order they normally happen
+HOPS = [
+    "request_sent",         # Chat completion request sent to OpenAI
+    "first_token",          # First text token streamed back
+    "first_chunk_sent",     # First text chunk sent to the ElevenLabs websocket
+    "first_audio_frame",    # First audio frame received from ElevenLabs
+    "first_audio_written",  # First audio bytes handed to the player
+]
+
+
+###### Classes ######
+
+class TurnTimer:
+    """Timestamps of each hop in one reply, relative to when the turn started."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = {}
+
+    def mark(self, hop):
+        # Only the first occurrence of each hop matters
+        if hop not in self.marks:
+            self.marks[hop] = time.perf_counter() - self.start
+
+    def waterfall(self, width=40):
+        """Render the hops as a text waterfall, with the time spent since the previous hop."""
+        if not self.marks:
+            return "No latency marks recorded."
+        total = max(self.marks.values()) or 1e-9
+        lines = []
+        previous = 0.0
+        for hop in HOPS:
+            if hop not in self.marks:
+                lines.append(f"{hop:<20} {'-':>8}")
+                continue
+            elapsed = self.marks[hop]
+            bar_start = int(previous / total * width)
+            bar_end = max(bar_start + 1, int(elapsed / total * width))
+            bar = " " * bar_start + "#" * (bar_end - bar_start)
+            lines.append(f"{hop:<20} {elapsed * 1000:>6.0f}ms  +{(elapsed - previous) * 1000:>5.0f}ms  |{bar:<{width}}|")
+            previous = max(previous, elapsed)
+        return "\n".join(lines)
+
+
+class SessionLatency:
+    """Collects the turn timers of a session for p50 / p95 summaries."""
+
+    def __init__(self):
+        self.turns = []
+
+    def add(self, timer):
+        self.turns.append(timer)
+
+    def summary(self):
+        if not self.turns:
+            return "No turns recorded."
+        lines = [f"Latency over {len(self.turns)} turns:", f"{'hop':<20} {'p50':>8} {'p95':>8}"]
+        for hop in HOPS:
+            values = sorted(turn.marks[hop] for turn in self.turns if hop in turn.marks)
+            if not values:
+                continue
+            lines.append(f"{hop:<20} {percentile(values, 0.5) * 1000:>6.0f}ms {percentile(values, 0.95) * 1000:>6.0f}ms")
+        return "\n".join(lines)
+
+
+###### Functions ######
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the values, 0.0 if there are none."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+###### Global Vars ######
+session = SessionLatency()
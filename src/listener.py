@@ -1,15 +1,102 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import collections
+import json
 import os
 import queue
 import sounddevice as sd
 import vosk
 import sys
+import time
 from threading import Semaphore
 
+from vad import EnergyVad
+
 q = queue.Queue()
 
+
+class TranscriptEvent:
+    """A recognized piece of speech. Partial events are the recognizer's running guess at the
+    current utterance, a final event is the finished utterance."""
+    PARTIAL = "partial"
+    FINAL = "final"
+
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+        self.time = time.monotonic()
+
+    def __repr__(self):
+        return f"TranscriptEvent({self.kind!r}, {self.text!r})"
+
+
+class AsyncTranscriptQueue:
+    """Transcript event queue that hands events from the listener thread to an asyncio event loop.
+
+    put() is called on the listener thread and schedules the event onto the loop with
+    call_soon_threadsafe, so consumers simply await get() and use no CPU while idle. When the
+    queue is full, the oldest partial event is dropped to make room, since a newer partial
+    supersedes it. Final events are never dropped.
+    """
+
+    def __init__(self, loop, maxsize=32):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.events = collections.deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The loop has already been closed on shutdown
+            pass
+
+    def _put(self, event):
+        if len(self.events) >= self.maxsize:
+            for i, queued in enumerate(self.events):
+                if queued.kind == TranscriptEvent.PARTIAL:
+                    del self.events[i]
+                    self.dropped += 1
+                    break
+            else:
+                if event.kind == TranscriptEvent.PARTIAL:
+                    # Full of finals, the new partial is the one to go
+                    self.dropped += 1
+                    return
+        self.events.append(event)
+        self.ready.set()
+
+    async def get(self):
+        while not self.events:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.events.popleft()
+
+
+class PartialThrottle:
+    """Drops partial results that haven't changed, and coalesces the rest to at most rate_hz."""
+
+    def __init__(self, rate_hz):
+        self.interval = 1 / rate_hz if rate_hz else 0
+        self.last_text = ""
+        self.last_emit = 0.0
+
+    def should_emit(self, text):
+        now = time.monotonic()
+        if text == self.last_text or now - self.last_emit < self.interval:
+            return False
+        self.last_text = text
+        self.last_emit = now
+        return True
+
+    def reset(self):
+        # A new utterance starts after every final result
+        self.last_text = ""
+
 def int_or_str(text):
     """Helper function for argument parsing."""
     try:
@@ -23,7 +110,10 @@ def callback(indata, frames, time, status):
         print(status, file=sys.stderr)
     q.put(bytes(indata))
     
-def run(transcript_queue=None, terminate_flag=None):
+def run(transcript_queue=None, terminate_flag=None, partial_rate_hz=4, use_vad=False, vad_options=None):
+    """Recognize speech from the microphone and put TranscriptEvents on transcript_queue.
+    With use_vad, only audio the voice activity detector considers speech reaches the
+    recognizer. vad_options are passed on to vad.EnergyVad."""
 
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument(
@@ -76,19 +166,49 @@ def run(transcript_queue=None, terminate_flag=None):
             print('#' * 80)
 
             rec = vosk.KaldiRecognizer(model, args.samplerate)
-            while True:
-                data = q.get()
-                if rec.AcceptWaveform(data):
-                    result = rec.Result()
-                    # print(result)
-                    transcript_queue.put((result, "final"))
+            throttle = PartialThrottle(partial_rate_hz)
+            detector = EnergyVad(args.samplerate, **(vad_options or {})) if use_vad else None
+            recognizer_cpu = 0.0
+            recognized_bytes = 0
+
+            def recognize(data, final=False):
+                nonlocal recognizer_cpu, recognized_bytes
+                start = time.process_time()
+                if data and rec.AcceptWaveform(data):
+                    text = json.loads(rec.Result())["text"]
+                    throttle.reset()
+                    transcript_queue.put(TranscriptEvent(TranscriptEvent.FINAL, text))
+                elif final:
+                    # The speech segment is over, so don't wait for the recognizer's own endpointing
+                    text = json.loads(rec.FinalResult())["text"]
+                    throttle.reset()
+                    if text:
+                        transcript_queue.put(TranscriptEvent(TranscriptEvent.FINAL, text))
                 else:
-                    # print(rec.PartialResult())
-                    transcript_queue.put((rec.PartialResult(), "partial"))
-                if dump_fn is not None:
-                    dump_fn.write(data)
-                if terminate_flag and terminate_flag.is_set():
-                    break
+                    text = json.loads(rec.PartialResult())["partial"]
+                    if text and throttle.should_emit(text):
+                        transcript_queue.put(TranscriptEvent(TranscriptEvent.PARTIAL, text))
+                recognizer_cpu += time.process_time() - start
+                recognized_bytes += len(data)
+
+            try:
+                while True:
+                    data = q.get()
+                    if detector is None:
+                        recognize(data)
+                    else:
+                        for speech, ended in detector.process(data):
+                            recognize(speech, final=ended)
+                    if dump_fn is not None:
+                        dump_fn.write(data)
+                    if terminate_flag and terminate_flag.is_set():
+                        break
+            finally:
+                if detector is not None and detector.total_frames:
+                    # Assume skipped audio would have cost the recognizer as much as the audio it did process
+                    cpu_per_byte = recognizer_cpu / recognized_bytes if recognized_bytes else 0.0
+                    skipped_bytes = (detector.total_frames - detector.forwarded_frames) * detector.frame_length * 2
+                    print(f"VAD skipped {detector.skipped_fraction:.0%} of audio, saving about {skipped_bytes * cpu_per_byte:.1f}s of recognizer CPU time.")
 
     except KeyboardInterrupt:
         print('\nDone')
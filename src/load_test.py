@@ -0,0 +1,115 @@
+###### Standard Imports ######
+import argparse
+import asyncio
+import json
+import time
+
+###### Third-Party Imports ######
+import websockets
+
+###### Local Imports ######
+from latency import percentile
+from settings import config
+
+
+###### Classes ######
+
+class SimulatedTypewriter:
+    """A load test client: types into its channel at a steady rate and times what it receives."""
+
+    def __init__(self, name, channel):
+        self.name = name
+        self.channel = channel
+        self.sent = 0
+        self.received = 0
+        self.latencies = []       # say -> message, seconds
+        self.first_tokens = []    # chat -> first token, seconds
+        self.replies = []         # chat -> done, seconds
+        self.chat_started = {}    # reply id -> send time
+        self.chat_done = asyncio.Event()
+
+    async def run(self, uri, messages, rate, chats, start_at):
+        async with websockets.connect(uri) as websocket:
+            await websocket.send(json.dumps({"type": "hello", "name": self.name}))
+            await websocket.send(json.dumps({"type": "join", "channel": self.channel}))
+            receiver = asyncio.create_task(self.receive(websocket))
+            await asyncio.sleep(max(0, start_at - time.perf_counter()))
+
+            for i in range(messages):
+                await websocket.send(json.dumps({
+                    "type": "say", "channel": self.channel, "text": f"{self.name} message {i}", "sent_at": time.perf_counter()
+                }))
+                self.sent += 1
+                await asyncio.sleep(1 / rate)
+
+            for i in range(chats):
+                self.chat_done.clear()
+                reply_id = f"{self.name}-{i}"
+                self.chat_started[reply_id] = time.perf_counter()
+                await websocket.send(json.dumps({"type": "chat", "id": reply_id, "text": "Say hello in five words."}))
+                await self.chat_done.wait()
+
+            # Give the last messages from the others time to arrive
+            await asyncio.sleep(1)
+            receiver.cancel()
+
+    async def receive(self, websocket):
+        async for raw in websocket:
+            now = time.perf_counter()
+            message = json.loads(raw)
+            kind = message["type"]
+            if kind == "message":
+                self.received += 1
+                self.latencies.append(now - message["sent_at"])
+            elif kind == "token" and message["id"] in self.chat_started and len(self.first_tokens) < len(self.chat_started):
+                self.first_tokens.append(now - self.chat_started[message["id"]])
+            elif kind in ("done", "error") and message.get("id") in self.chat_started:
+                if kind == "done":
+                    self.replies.append(now - self.chat_started[message["id"]])
+                self.chat_done.set()
+
+
+###### Functions ######
+
+def format_ms(values):
+    if not values:
+        return f"{'-':>7} {'-':>7}"
+    return f"{percentile(values, 0.5) * 1000:>5.0f}ms {percentile(values, 0.95) * 1000:>5.0f}ms"
+
+
+async def run_load_test(uri, clients, room_size, messages, rate, chats):
+    typewriters = [SimulatedTypewriter(f"typewriter-{i}", f"room-{i // room_size}") for i in range(clients)]
+    # Every client connects first, then they all start typing at once
+    start_at = time.perf_counter() + 1 + clients * 0.01
+    await asyncio.gather(*(typewriter.run(uri, messages, rate, chats, start_at) for typewriter in typewriters))
+    elapsed = time.perf_counter() - start_at
+
+    print(f"{'client':<16} {'sent':>5} {'recv':>5} {'msg p50':>7} {'msg p95':>7} {'ttft p50':>7} {'ttft p95':>7}")
+    for typewriter in typewriters:
+        print(f"{typewriter.name:<16} {typewriter.sent:>5} {typewriter.received:>5} {format_ms(typewriter.latencies)} {format_ms(typewriter.first_tokens)}")
+
+    sent = sum(typewriter.sent for typewriter in typewriters)
+    received = sum(typewriter.received for typewriter in typewriters)
+    latencies = [value for typewriter in typewriters for value in typewriter.latencies]
+    replies = [value for typewriter in typewriters for value in typewriter.replies]
+    print(f"\n{clients} clients sent {sent} messages and received {received} in {elapsed:.1f}s: "
+          f"{sent / elapsed:.1f} msg/s in, {received / elapsed:.1f} msg/s out")
+    print(f"Message latency p50 / p95: {format_ms(latencies)}")
+    if chats:
+        print(f"Full reply p50 / p95:      {format_ms(replies)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat server with simulated typewriters.")
+    parser.add_argument("--uri", default=f"ws://localhost:{config.get('server_port', 8765)}", help="chat server to connect to")
+    parser.add_argument("--clients", type=int, default=30, help="number of simulated typewriters")
+    parser.add_argument("--room-size", type=int, default=3, help="typewriters sharing each channel")
+    parser.add_argument("--messages", type=int, default=50, help="messages each typewriter types")
+    parser.add_argument("--rate", type=float, default=5, help="messages per second from each typewriter")
+    parser.add_argument("--chats", type=int, default=0, help="persona replies each typewriter asks for, these call the chat model")
+    args = parser.parse_args()
+    asyncio.run(run_load_test(args.uri, args.clients, args.room_size, args.messages, args.rate, args.chats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+###### Standard Imports ######
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+###### Local Imports ######
+from resizer import preprocess_image
+from settings import config
+
+###### Global Vars ######
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+
+
+###### Functions ######
+
+def is_up_to_date(entry, image_path, output_dir, new_width):
+    if entry is None or entry["target_width"] != new_width:
+        return False
+    if not os.path.exists(os.path.join(output_dir, entry["file"])):
+        return False
+    stat = os.stat(image_path)
+    return (stat.st_mtime_ns, stat.st_size) == (entry["source_mtime_ns"], entry["source_size"])
+
+
+def preprocess_images(images_dir=config["images_dir"], output_dir=config["derived_images_dir"], new_width=1024, workers=None, force=False):
+    """Resize and re-encode every image in images_dir across a process pool, and record the
+    results in output_dir/manifest.json for images.get_base64_image_url to pick up.
+    Images that haven't changed since the last run are skipped unless force is set.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+
+    image_names = sorted(
+        name for name in os.listdir(images_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    pending = [
+        name for name in image_names
+        if force or not is_up_to_date(manifest.get(name), os.path.join(images_dir, name), output_dir, new_width)
+    ]
+    print(f"Preprocessing {len(pending)} of {len(image_names)} images.")
+
+    start = time.monotonic()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(preprocess_image, os.path.join(images_dir, name), output_dir, new_width): name
+            for name in pending
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                manifest[name] = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed to preprocess {name}: {type(e).__name__}: {e}")
+    elapsed = time.monotonic() - start
+
+    # Drop entries for images that have been removed since the last run
+    manifest = {name: entry for name, entry in manifest.items() if name in image_names}
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+    processed = len(pending) - failed
+    images_per_second = processed / elapsed if elapsed > 0 else 0
+    print(f"Preprocessed {processed} images ({failed} failed) in {elapsed:.1f}s: {images_per_second:.1f} images/second.")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resize every image in the images directory ahead of a batch of stories.")
+    parser.add_argument("--images-dir", default=config["images_dir"], help="directory of source images")
+    parser.add_argument("--output-dir", default=config["derived_images_dir"], help="directory for the resized images and manifest")
+    parser.add_argument("--width", type=int, default=1024, help="maximum width of the resized images")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, defaults to the CPU count")
+    parser.add_argument("--force", action="store_true", help="reprocess images even if they are up to date")
+    args = parser.parse_args()
+    preprocess_images(args.images_dir, args.output_dir, args.width, args.workers, args.force)
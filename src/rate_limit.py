@@ -0,0 +1,41 @@
+###### Standard Imports ######
+import asyncio
+import time
+
+
+###### Classes ######
+
+class TokenBudget:
+    """Token bucket that holds requests back so the total stays under a tokens-per-minute limit.
+
+    Each request reserves an estimate of its token usage up front with acquire(), then
+    settle() corrects the bucket once the actual usage is known.
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.available = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens):
+        # A single request larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return tokens
+                await asyncio.sleep((tokens - self.available) / self.rate)
+
+    def settle(self, reserved, used):
+        # Usage beyond the estimate can push the bucket negative, which delays the next requests
+        self._refill()
+        self.available = min(self.capacity, self.available + reserved - used)
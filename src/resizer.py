@@ -1,19 +1,60 @@
+import hashlib
+import os
+
 from PIL import Image
 
-def resize_image(input_image_path, output_image_path, new_width):
+def resize_image(input_image_path, output_image_path, new_width, quality=90, image_format=None):
+    """Downscale an image to at most new_width pixels wide, keeping its aspect ratio.
+    JPEGs are decoded straight at a reduced scale via draft mode before the final resample.
+    The image is saved in image_format if given, otherwise in the source's format.
+    Returns the size of the saved image, or None if the image was already small enough to leave in place."""
     with Image.open(input_image_path) as img:
         original_width, original_height = img.size
-        if original_width <= new_width:
-            return
-        aspect_ratio = original_height / original_width
-        new_height = int(new_width * aspect_ratio)
-        resized_img = img.resize((new_width, new_height), Image.ANTIALIAS)
-        resized_img.save(output_image_path)
-        print(f"The image has been resized to {new_width}x{new_height}")
-
-# Example usage:
-input_image_path = './data/image.png'
-output_image_path = './data/image.png'
-new_width = 800  # You can change this to your desired width
-
-resize_image(input_image_path, output_image_path, new_width)
+        if original_width <= new_width and input_image_path == output_image_path:
+            return None
+        new_height = max(1, int(new_width * original_height / original_width))
+        if original_width > new_width:
+            # Only has an effect on JPEGs, and must happen before the image data is loaded
+            img.draft(img.mode, (new_width, new_height))
+            img.thumbnail((new_width, new_height), Image.LANCZOS)
+            print(f"The image has been resized to {img.size[0]}x{img.size[1]}")
+
+        image_format = image_format or img.format or Image.registered_extensions().get(os.path.splitext(output_image_path)[1].lower())
+        if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(output_image_path, format=image_format, quality=quality)
+        return img.size
+
+def preprocess_image(input_image_path, output_dir, new_width):
+    """Write a normalized copy of an image to output_dir and return its manifest entry.
+    This is the worker for preprocess_images.py, so it only depends on PIL."""
+    with open(input_image_path, "rb") as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+
+    with Image.open(input_image_path) as img:
+        has_alpha = img.mode in ("RGBA", "LA", "P")
+    extension = ".png" if has_alpha else ".jpg"
+    # The digest keeps photo.png and photo.jpg, or same-named images from other directories, apart
+    output_name = f"{os.path.splitext(os.path.basename(input_image_path))[0]}_{digest[:12]}_{new_width}{extension}"
+    output_path = os.path.join(output_dir, output_name)
+    size = resize_image(input_image_path, output_path, new_width, image_format="PNG" if has_alpha else "JPEG")
+
+    stat = os.stat(input_image_path)
+    return {
+        "file": output_name,
+        "mime": "image/png" if has_alpha else "image/jpeg",
+        "width": size[0],
+        "height": size[1],
+        "target_width": new_width,
+        "source_digest": digest,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_size": stat.st_size,
+    }
+
+if __name__ == "__main__":
+    # Example usage:
+    input_image_path = './data/image.png'
+    output_image_path = './data/image.png'
+    new_width = 800  # You can change this to your desired width
+
+    resize_image(input_image_path, output_image_path, new_width)
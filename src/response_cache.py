@@ -0,0 +1,67 @@
+###### Standard Imports ######
+import hashlib
+import json
+
+###### Local Imports ######
+from disk_cache import DiskCache
+from settings import config
+
+###### Global Vars ######
+OFF = "off"
+READ_WRITE = "read_write"
+REPLAY = "replay"
+
+
+###### Classes ######
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+class ResponseCache(DiskCache):
+    """On-disk cache of chat completion responses, keyed by a hash of the request.
+    Each entry is a small JSON file, evicted least recently used first."""
+
+    def __init__(self, cache_dir, max_bytes, mode=READ_WRITE):
+        if mode not in (OFF, READ_WRITE, REPLAY):
+            raise ValueError(f"Unknown response cache mode: {mode}")
+        super().__init__(cache_dir, max_bytes, extension=".json")
+        self.mode = mode
+
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens, logit_bias):
+        request = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "logit_bias": {str(token): value for token, value in (logit_bias or {}).items()},
+        }
+        encoded = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached entry for key, or None if there isn't one."""
+        if self.mode == OFF:
+            return None
+        data = self.get_bytes(key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            # A corrupted entry is as good as a miss
+            return None
+
+    def put(self, key, entry):
+        if self.mode != READ_WRITE:
+            return
+        self.put_bytes(key, json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+
+
+###### Global Vars ######
+cache = ResponseCache(
+    config["response_cache_dir"],
+    config["response_cache_max_mb"] * 1024 * 1024,
+    config["response_cache_mode"],
+)
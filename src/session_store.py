@@ -0,0 +1,81 @@
+###### Standard Imports ######
+import json
+import os
+import re
+
+###### Local Imports ######
+from settings import config
+
+
+###### Classes ######
+
+class SessionLog:
+    """Append-only JSONL log of a conversation's events, one line per event.
+
+    Each turn costs one appended line, however long the history is, and replaying the
+    events rebuilds the history exactly. A line torn by a crash mid-write is skipped.
+    With fsync=True every event is on disk before append() returns.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def events(self):
+        if not self.exists():
+            return
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def append(self, event):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, "a+b")
+            if self.file.tell() > 0:
+                self.file.seek(-1, os.SEEK_END)
+                if self.file.read(1) != b"\n":
+                    # End the torn line, so it doesn't swallow this one
+                    self.file.write(b"\n")
+        self.file.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+###### Functions ######
+
+def get_log_path(name, namespace=None):
+    """Logs of the console's own conversations sit in sessions_dir itself, others in a subdirectory per namespace."""
+    safe_name = re.sub(r"[^\w.-]", "_", name)
+    if namespace is None:
+        return os.path.join(config["sessions_dir"], f"{safe_name}.jsonl")
+    return os.path.join(config["sessions_dir"], re.sub(r"[^\w.-]", "_", namespace), f"{safe_name}.jsonl")
+
+
+def list_sessions():
+    """Names of the console's conversations with a log, without reading any of them.
+    Logs in namespaces, e.g. the chat server's, aren't included."""
+    if not os.path.isdir(config["sessions_dir"]):
+        return []
+    with os.scandir(config["sessions_dir"]) as entries:
+        return [entry.name[:-len(".jsonl")] for entry in entries if entry.is_file() and entry.name.endswith(".jsonl")]
+
+
+def get_log(name, namespace=None):
+    """Return the log of the named conversation, or None if sessions aren't kept."""
+    if not config.get("keep_sessions", True):
+        return None
+    return SessionLog(get_log_path(name, namespace))
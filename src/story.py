@@ -4,10 +4,13 @@ import random
 from enum import IntEnum
 
 import gpt_synchonous as gpt
-from authors import Author
+from authors import Author, get_author
+from dag import Stage, run_stages
 from settings import config
 import bias
 import images
+import image_store
+from session_store import SessionLog
     
 class StoryPoint(IntEnum):
     CLEAR = 0
@@ -22,6 +25,7 @@ class StoryPoint(IntEnum):
     SECOND_REFINEMENT = 9
     FINAL_REFINEMENT = 10
 
+# Stages at 1.0 and above pass use_cache=False so that re-running them produces a fresh draft
 class Temperatures:
     IMAGE_NOTES = 0.8
     MOTIVATIONS = 1.2
@@ -40,7 +44,7 @@ class Story:
     def create_empty_story(cls, story_name):
         Story(story_name, None, None, no_load=True)
 
-    def __init__(self, story_name, author_name, image_name=None, image_url=None, image_notes=None, no_load=False):
+    def __init__(self, story_name, author_name, image_name=None, image_url=None, image_notes=None, no_load=False, load_author=True):
         self.image_name = image_name
         self.image_url = image_url
         self.story_name = story_name
@@ -56,35 +60,60 @@ class Story:
         self.second_refinement = None
         self.final_refinement = None
         self.image_notes = image_notes
+        self.seed = story_name  # Saved with the story, so its random choices are the same on every run
+        self.message_marks = {}  # stage attribute -> number of messages before the stage added its own
         self.messages = [
                 {"role": "system", "content": f"You are a chatbot that assists with the writing of stories in the style of {self.author_name}. You have vision processing capabilities and can also process images. Your output will be processed programmatically, so please follow the instructions carefully and do not add additional commentary to your responses."}
         ]
         
         self.story_path = os.path.join(config["stories_dir"], f"{self.story_name}.json")
+        self.log = SessionLog(os.path.join(config["stories_dir"], f"{self.story_name}.checkpoints.jsonl"), fsync=True)
+        self.saved_fields = {}
+        self.saved_message_count = 0
         
         if not no_load:
-            self.load_json()
+            if self.log.exists():
+                self.load_checkpoints()
+            else:
+                self.load_json()
         
-            # This attribute is not saved to the JSON file, so it needs to be reinitialized
-            self.author = Author(author_name)
+            # This attribute is not saved to the JSON file, so it needs to be reinitialized.
+            # Pass load_author=False to leave it to the "author" stage of generate().
+            if load_author:
+                self.author = Author(author_name)
         
+    def begin_stage(self, attribute):
+        """Note where the messages of the stage filling in the attribute start, so reset_to can drop them."""
+        self.message_marks[attribute] = len(self.messages)
+
+    def get_random(self, stage):
+        """Return a random generator for the choices of a stage, seeded by the story and the stage.
+        Re-running a stage, after a reset too, then sends the same prompt, which replay mode needs
+        to find its response, however the concurrent stages happen to interleave. Give the story
+        another seed for other choices."""
+        return random.Random(f"{self.seed}:{stage}")
+
     def get_image_notes(self):
+        return gpt.run_sync(self.aget_image_notes())
+
+    async def aget_image_notes(self):
         if self.image_notes is None:
             print(f"Generating image notes for {self.story_name}.")
+            self.begin_stage("image_notes")
             prompt = f"Analyze the attached image and list as bullet points the following information about the subject: gender, age (guess a specific age), clothing details, body language, ethnic origin, facial expression, facial details (including, among other details, eye color and facial feature shape), hairstyle."
             content = [{"type": "text", "text": prompt}]
             
             if self.image_name is not None:
-                image_url = images.get_base64_image_url(self.image_name)
+                image_url = images.get_image_ref(self.image_name)
                 content.append({"type": "image_url", "image_url": {"url": image_url}})
             elif self.image_url is not None:
-                content.append({"type": "image_url", "image_url": {"url": self.image_url}})
+                content.append({"type": "image_url", "image_url": {"url": image_store.store.intern(self.image_url)}})
             else:
                 print("An image name or URL must be provided to generate image notes.")
                 exit()
                 
             self.messages.append({"role": "user", "content": content})
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.IMAGE_NOTES)
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.IMAGE_NOTES, stage="story.image_notes")
             self.image_notes = response
             
             self.messages.append({"role": "assistant", "content": f"Image notes: {self.image_notes}"})
@@ -97,18 +126,31 @@ class Story:
             arcs = json.load(file)
             return arcs
     
-    def get_character_motivations(self):
-        
-        if self.story_arc is None:    
+    def choose_story_arc(self):
+        if self.story_arc is None:
             arcs = self.fetch_story_arcs()
-            self.story_arc = random.sample(arcs.keys(), 1)[0]
+            self.story_arc = self.get_random("story_arc").sample(list(arcs.keys()), 1)[0]
+            self.save()
+        return self.story_arc
+    
+    def choose_themes(self):
+        if self.story_themes == []:
+            self.story_themes = self.get_random("themes").sample(self.author.themes, 2)
             self.save()
+        return self.story_themes
+    
+    def get_character_motivations(self):
+        return gpt.run_sync(self.aget_character_motivations())
+
+    async def aget_character_motivations(self):
+        
+        self.choose_story_arc()
         
         if self.motivations is None:
             print(f"Generating character motivations for {self.story_name}.")
+            self.begin_stage("motivations")
             
-            if self.story_themes == []:
-                self.story_themes = random.sample(self.author.themes, 2)
+            self.choose_themes()
                 
             self.messages.append({"role": "user", "content": f"The story will use the following of the 8 story arcs defined by Kurt Vonnegut: {self.story_arc} -- {self.fetch_story_arcs()[self.story_arc]}. The story will be inspired by the themes of {', '.join(self.story_themes)}."})
             self.messages.append({"role": "assistant", "content": "I will make sure the story I generate follows that arc and those themes."})
@@ -118,7 +160,7 @@ class Story:
             
             self.messages.append({"role": "user", "content": prompt})
             
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.MOTIVATIONS, logit_bias=bias.get_bias())
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.MOTIVATIONS, logit_bias=bias.get_bias(), use_cache=False, stage="story.motivations")
             self.motivations = response
             self.messages.append({"role": "assistant", "content": f"Character motivations: {self.motivations}"})
 
@@ -126,18 +168,21 @@ class Story:
         return self.motivations
     
     def get_start_middle_end(self):
+        return gpt.run_sync(self.aget_start_middle_end())
+
+    async def aget_start_middle_end(self):
         
         if self.s_m_e is None:
             print(f"Generating start / middle / end for {self.story_name}.")
+            self.begin_stage("s_m_e")
             
-            if self.story_themes == []:
-                self.story_themes = random.sample(self.author.themes, 2)
+            self.choose_themes()
             
             prompt = f"Given the character motivations and story arc I also gave told you, write a brief outline of a story that includes a captivating start, a compelling middle, and a complex ending. The outline should be descriptive and matter of fact. It should not be flowery, as it is simply describing what will happen in the story. The story should be inspired by the themes of {', '.join(self.story_themes)}. List the start, middle, and end as separate bullet points. Although the story is short, there should be a clear three act structure that follows the story arc. I gave you."
             
             self.messages.append({"role": "user", "content": prompt})
           
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.SME, logit_bias=bias.get_bias())
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.SME, logit_bias=bias.get_bias(), use_cache=False, stage="story.start_middle_end")
             self.s_m_e = response
             self.messages.append({"role": "assistant", "content": f"Story Outline: {self.s_m_e}"})
           
@@ -145,72 +190,94 @@ class Story:
         return self.s_m_e
     
     def get_intro_idea(self):
+        return gpt.run_sync(self.aget_intro_idea())
+
+    async def aget_intro_idea(self):
         
         with open(os.path.join(config["data_dir"], "rhetorical_devices.json"), "r") as file:
             rhethorical_devices = json.load(file)
             
         if self.intro_idea is None:
             print(f"Generating introduction ideas for {self.story_name}.")
-            literary_devices = ", ".join(random.sample(self.author.devices, 2))
-            prompt = f"Given the story outline and character motivations from earlier, generate a unique and captivating rhetorical idea for the introduction of the story, inspired by the following literary devices: {literary_devices}. The idea should be thought-provoking, engaging, and set the stage for a compelling narrative that follows the given plot arc. The idea should be fresh and original. Character motivations: {self.get_character_motivations()}. Plot outline: {self.s_m_e}. Some examples of interesting rhetorical ideas include: {random.shuffle(rhethorical_devices)}"
+            self.begin_stage("intro_idea")
+            rng = self.get_random("intro_idea")
+            literary_devices = ", ".join(rng.sample(self.author.devices, 2))
+            motivations = await self.aget_character_motivations()
+            prompt = f"Given the story outline and character motivations from earlier, generate a unique and captivating rhetorical idea for the introduction of the story, inspired by the following literary devices: {literary_devices}. The idea should be thought-provoking, engaging, and set the stage for a compelling narrative that follows the given plot arc. The idea should be fresh and original. Character motivations: {motivations}. Plot outline: {self.s_m_e}. Some examples of interesting rhetorical ideas include: {rng.shuffle(rhethorical_devices)}"
 
             self.messages.append({"role": "user", "content": prompt})
 
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.INTRO_IDEA, logit_bias=bias.get_bias())
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.INTRO_IDEA, logit_bias=bias.get_bias(), use_cache=False, stage="story.intro_idea")
             self.intro_idea = response
             self.messages.append({"role": "assistant", "content": f"Introduction Idea: {self.intro_idea}"})
             self.save()
         return self.intro_idea
     
     def get_story(self):
+        return gpt.run_sync(self.aget_story())
+
+    async def aget_story(self):
         if self.story is None:
             print(f"Generating story for {self.story_name}.")
-            this_vocab = ', '.join(random.sample(self.author.get_vocab(), 50))
+            self.begin_stage("story")
+            this_vocab = ', '.join(self.get_random("story").sample(sorted(await self.author.aget_vocab()), 50))
             prompt = f"You now know the character description, motivations, story themes, story arc, story outline, and have an idea for an interesting way to begin the story. Using that information from earlier, write the a 500 word story that follows those guidelines. Be sure to ues the story outline and introduction idea, but do not repeat them verbatim. Make sure that each paragraph in the story moves the action forward. Avoid use of the passive voice. Focus more on actions of the main character than descriptions of main character. Incorporate at at least one, but no more than two oblique references to the character's physical appears as described in the image notes. To further refine the story, incorporate some of the following vocabulary words for extra flair: {this_vocab}. These are complex words that should be used sparingly to enhance the story, not detract from it."
             
             self.messages.append({"role": "user", "content": prompt})
             
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.STORY, logit_bias=bias.get_bias())
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.STORY, logit_bias=bias.get_bias(), use_cache=False, stage="story.story")
             self.story = response
             self.messages.append({"role": "assistant", "content": f"Story first draft: {self.story}"})
             self.save()
         return self.story
     
     def get_first_refinement(self):
+        return gpt.run_sync(self.aget_first_refinement())
+
+    async def aget_first_refinement(self):
         if self.first_refinement is None:
             print(f"Generating first refinement for {self.story_name}.")
-            this_vocab = ', '.join(random.sample(self.author.get_vocab(), 50))
+            self.begin_stage("first_refinement")
+            this_vocab = ', '.join(self.get_random("first_refinement").sample(sorted(await self.author.aget_vocab()), 50))
             prompt = f"You will now edit the first draft of the story. Take on the roll of an editor at The New Yorker, ensuring that the story meets the highest standards for excellents in literature. Streamline the writing, cut excessive adjectives, reword awkward turns of phrase. There is no need to maintain the existing structure if you think you can restructuring and rewriting it will improve the quality and better align with {self.author.name}'s style, vocabulary, and sentence structure, so long as you maintain the character's motivations, plot arc, and story outline. Some vocabulary words to consider incorporating are: {this_vocab}. Do not use the vocabulary words excessively, but do use them when they will enhance the story. Do not remove them where they already exist. Do not reference these instructions in the story."
 
             self.messages.append({"role": "user", "content": prompt}),
                                  
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.FIRST_REFINEMENT, logit_bias=bias.get_bias())
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.FIRST_REFINEMENT, logit_bias=bias.get_bias(), use_cache=False, stage="story.first_refinement")
             self.first_refinement = response
             self.messages.append({"role": "assistant", "content": f"First Refinement: {self.first_refinement}"})
             self.save()
         return self.first_refinement
     
     def get_second_refinement(self):
+        return gpt.run_sync(self.aget_second_refinement())
+
+    async def aget_second_refinement(self):
         if self.second_refinement is None:
             print(f"Generating second refinement for {self.story_name}.")
+            self.begin_stage("second_refinement")
             prompt = f"This is your second edit of the story draft. In this revision, focus on removing redundancy and cliches, and condense or rephrase repetitive sections. Do not reference these instructions in the story."
             
             self.messages.append({"role": "user", "content": prompt})
             
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.SECOND_REFINEMENT, logit_bias=bias.get_bias())
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.SECOND_REFINEMENT, logit_bias=bias.get_bias(), stage="story.second_refinement")
             self.second_refinement = response
             self.save()
             
         return self.second_refinement
     
     def get_final_refinement(self):
+        return gpt.run_sync(self.aget_final_refinement())
+
+    async def aget_final_refinement(self):
         if self.final_refinement is None:
             print(f"Generating final refinement for {self.story_name}.")
+            self.begin_stage("final_refinement")
             prompt = f"This is your final opportunity to enhance this story, which is already written in the style of {self.author_name}. Maintain the style, but go over it with a fine toothed comb one more time to find any hints that indicate the story might have been written by an AI and rephrase them to sound more human and less cliche. Reword any repetative word usages. Look for instances of the following cliched words and phrases and reword them in a way that is more in line with how {self.author_name} would say it: {', '.join(bias.banned_words)}. Do not reference these instructions in the story. "
    
             self.messages.append({"role": "user", "content": prompt})
             
-            response = gpt.get_synchonous_response(messages=self.messages, temperature=Temperatures.FINAL_REFINEMENT, logit_bias=bias.get_bias())
+            response = await gpt.get_async_response(messages=self.messages, temperature=Temperatures.FINAL_REFINEMENT, logit_bias=bias.get_bias(), stage="story.final_refinement")
             self.final_refinement = response
             self.messages.append({"role": "assistant", "content": f"Final Refinement: {self.final_refinement}"})
             self.save()
@@ -218,36 +285,116 @@ class Story:
         print(f"Final refinement: {self.final_refinement}\n")
         return self.final_refinement
             
-    def save(self):
+    async def aload_author(self):
+        if self.author is None:
+            self.author = await get_author(self.author_name)
+        return self.author
+    
+    def get_stages(self):
+        """Declare the story pipeline as a dependency graph. The author bootstrap, image notes
+        and story arc selection don't depend on each other, so they run concurrently. Every
+        stage from the motivations onward builds on the conversation so far and runs in order."""
+        
+        async def choose_story_arc():
+            return self.choose_story_arc()
+        
+        async def choose_themes():
+            return self.choose_themes()
+        
+        return [
+            Stage("author", self.aload_author),
+            Stage("image_notes", self.aget_image_notes),
+            Stage("story_arc", choose_story_arc),
+            Stage("themes", choose_themes, deps=["author"]),
+            Stage("motivations", self.aget_character_motivations, deps=["image_notes", "story_arc", "themes"]),
+            Stage("start_middle_end", self.aget_start_middle_end, deps=["motivations"]),
+            Stage("intro_idea", self.aget_intro_idea, deps=["start_middle_end"]),
+            Stage("story", self.aget_story, deps=["intro_idea"]),
+            Stage("first_refinement", self.aget_first_refinement, deps=["story"]),
+            Stage("second_refinement", self.aget_second_refinement, deps=["first_refinement"]),
+            Stage("final_refinement", self.aget_final_refinement, deps=["second_refinement"]),
+        ]
+    
+    def generate(self):
+        return gpt.run_sync(self.agenerate())
+    
+    async def agenerate(self):
+        """Run every stage of the story that hasn't been completed yet and return the final refinement."""
+        results = await run_stages(self.get_stages())
+        self.write_text()
+        return results["final_refinement"]
+            
+    def get_fields(self):
         # Create a copy of the object's dictionary
         data_to_save = self.__dict__.copy()
         
         # List of attributes to exclude from being saved
-        exclude_keys = ['author', 'author_file_path', 'story_path', 'messages']
+        exclude_keys = ['author', 'author_file_path', 'story_path', 'messages', 'log', 'saved_fields', 'saved_message_count']
         
         # Remove the keys you don't want to save
         for key in exclude_keys:
             data_to_save.pop(key, None)  # Use pop to remove the key, does nothing if key doesn't exist
-
-        # Save the remaining data to a JSON file
-        with open(self.story_path, "w") as file:
-            json.dump(data_to_save, file, indent=4, sort_keys=True)
-            
+        return data_to_save
+    
+    def save(self):
+        """Append a checkpoint to the story's log with the attributes that changed and the messages
+        of the stages finished since the last one. Each checkpoint is on disk before the next stage starts."""
+        # Round trip through JSON, so later changes to lists and dicts show up as differences
+        fields = json.loads(json.dumps(self.get_fields()))
+        changed = {key: value for key, value in fields.items() if key not in self.saved_fields or self.saved_fields[key] != value}
+        # A stage still waiting on its reply, e.g. the image notes while the themes are chosen,
+        # would leave its prompt unanswered in the log, so messages stop where it started
+        pending = [mark for attribute, mark in self.message_marks.items() if getattr(self, attribute) is None]
+        message_count = min(pending, default=len(self.messages))
+        new_messages = self.messages[self.saved_message_count:message_count]
+        if not changed and not new_messages:
+            return
+        
+        # The log outlives the in-memory image store, so its images have to be on disk
+        for message in new_messages:
+            if not isinstance(message["content"], str):
+                for part in message["content"]:
+                    if part["type"] == "image_url":
+                        image_store.store.persist(part["image_url"]["url"])
+        
+        self.log.append({"event": "checkpoint", "fields": changed, "messages": new_messages})
+        self.saved_fields.update(changed)
+        self.saved_message_count = message_count
+    
+    def load_checkpoints(self):
+        print(f"Loading {self.story_name} from its checkpoints.")
+        self.messages = []
+        for event in self.log.events():
+            if event["event"] == "checkpoint":
+                self.__dict__.update(event["fields"])
+                self.messages.extend(event["messages"])
+            elif event["event"] == "reset":
+                del self.messages[event["message_count"]:]
+        self.saved_fields = json.loads(json.dumps(self.get_fields()))
+        self.saved_message_count = len(self.messages)
+    
+    def get_text(self):
+        return (
+            f"Image Notes:\n{self.image_notes}\n\n"
+            f"Themes:\n{', '.join(self.story_themes)}\n\n"
+            f"Story Arc:\n{self.story_arc}\n\n"
+            f"Character Motivations:\n{self.motivations}\n\n"
+            f"Start / Middle / End:\n{self.s_m_e}\n\n"
+            f"Introduction Idea:\n{self.intro_idea}\n\n"
+            f"Story:\n{self.story}\n\n"
+            f"First Refinement:\n{self.first_refinement}\n\n"
+            f"Second Refinement:\n{self.second_refinement}\n\n"
+            f"Final Refinement:\n{self.final_refinement}\n\n"
+        )
+    
+    def write_text(self):
         ### Save the text of the story to a text file
         text_path = os.path.join(config["stories_dir"], f"{self.story_name}.txt")
         with open(text_path, "w", encoding="utf-8") as file:
-            file.write(f"Image Notes:\n{self.image_notes}\n\n")
-            file.write(f"Themes:\n{', '.join(self.story_themes)}\n\n")
-            file.write(f"Story Arc:\n{self.story_arc}\n\n")
-            file.write(f"Character Motivations:\n{self.motivations}\n\n")
-            file.write(f"Start / Middle / End:\n{self.s_m_e}\n\n")
-            file.write(f"Introduction Idea:\n{self.intro_idea}\n\n")
-            file.write(f"Story:\n{self.story}\n\n")
-            file.write(f"First Refinement:\n{self.first_refinement}\n\n")
-            file.write(f"Second Refinement:\n{self.second_refinement}\n\n")
-            file.write(f"Final Refinement:\n{self.final_refinement}\n\n")
+            file.write(self.get_text())
             
     def load_json(self):
+        """Load a story saved before checkpoints were kept. Its messages weren't saved."""
         if os.path.exists(self.story_path):
             print(f"Loading {self.story_name} from JSON.")
             with open(self.story_path, "r") as file:
@@ -275,18 +422,20 @@ class Story:
             self.second_refinement = None
         if story_point <= StoryPoint.SECOND_REFINEMENT:
             self.final_refinement = None
+        
+        # Drop the messages of the stages that were cleared, so they are redone with the right context
+        cleared = [attribute for attribute in self.message_marks if getattr(self, attribute) is None]
+        if cleared:
+            message_count = min(self.message_marks.pop(attribute) for attribute in cleared)
+            if message_count < len(self.messages):
+                del self.messages[message_count:]
+                self.log.append({"event": "reset", "message_count": message_count})
+                self.saved_message_count = min(self.saved_message_count, message_count)
         self.save()
         
     
 if __name__ == "__main__":
             
-    story = Story("Michael Story New", "D.H. Lawrence", image_name="michael.jpg")
+    story = Story("Michael Story New", "D.H. Lawrence", image_name="michael.jpg", load_author=False)
     story.reset_to(StoryPoint.CLEAR)
-    story.get_image_notes()
-    story.get_character_motivations()
-    story.get_start_middle_end()
-    story.get_intro_idea()
-    story.get_story()
-    story.get_first_refinement()
-    story.get_second_refinement()
-    story.get_final_refinement()
+    story.generate()
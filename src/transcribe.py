@@ -0,0 +1,219 @@
+###### Standard Imports ######
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+import wave
+
+###### Third-Party Imports ######
+import ffmpeg
+import numpy as np
+from openai import AsyncOpenAI
+
+###### Local Imports ######
+from disk_cache import DiskCache
+import settings
+from settings import config
+
+###### Global Vars ######
+SAMPLE_RATE = 16000  # Speech models don't need more, and it keeps the uploads small
+FRAME_MS = 30
+
+
+###### Classes ######
+
+class OpenAITranscriber:
+    """Transcribes WAV bytes with the OpenAI audio API, or any server that speaks it, e.g. a local whisper."""
+
+    def __init__(self, model="whisper-1", base_url=None):
+        self.model = model
+        self.client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, base_url=base_url)
+        self.name = f"openai:{base_url or 'default'}:{model}"
+
+    async def transcribe(self, wav_bytes):
+        transcription = await self.client.audio.transcriptions.create(
+            model=self.model,
+            file=("segment.wav", wav_bytes),
+            response_format="text"
+        )
+        return transcription.strip()
+
+
+class VoskTranscriber:
+    """Transcribes WAV bytes locally with the same Vosk model as the listener, no network needed."""
+
+    def __init__(self, model_path="model"):
+        import vosk
+        self.vosk = vosk
+        self.model = vosk.Model(model_path)
+        self.name = f"vosk:{os.path.abspath(model_path)}"
+
+    def _transcribe(self, wav_bytes):
+        with wave.open(io.BytesIO(wav_bytes)) as wav:
+            recognizer = self.vosk.KaldiRecognizer(self.model, wav.getframerate())
+            texts = []
+            while True:
+                data = wav.readframes(4000)
+                if not data:
+                    break
+                if recognizer.AcceptWaveform(data):
+                    texts.append(json.loads(recognizer.Result())["text"])
+            texts.append(json.loads(recognizer.FinalResult())["text"])
+        return " ".join(text for text in texts if text)
+
+    async def transcribe(self, wav_bytes):
+        return await asyncio.to_thread(self._transcribe, wav_bytes)
+
+
+###### Functions ######
+
+def get_transcriber(endpoint=None):
+    endpoint = endpoint or config.get("transcription_endpoint", "openai")
+    if endpoint == "openai":
+        return OpenAITranscriber(config.get("transcription_model", "whisper-1"), config.get("transcription_base_url"))
+    elif endpoint == "vosk":
+        return VoskTranscriber(config.get("transcription_vosk_model", "model"))
+    raise ValueError(f"Unknown transcription endpoint: {endpoint}")
+
+
+def decode_audio(path):
+    """Decode any file ffmpeg can read to 16 kHz mono 16-bit samples, without an intermediate file."""
+    data, _ = (
+        ffmpeg.input(path)
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return np.frombuffer(data, dtype=np.int16)
+
+
+def find_cuts(samples, segment_s, search_s):
+    """Pick cut points roughly segment_s apart, each moved to the quietest frame within search_s of its target."""
+    frame_length = SAMPLE_RATE * FRAME_MS // 1000
+    frame_count = len(samples) // frame_length
+    if frame_count == 0:
+        return [0, len(samples)]
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length).astype(np.float32)
+    energy = np.mean(frames * frames, axis=1)
+
+    frames_per_segment = int(segment_s * 1000 / FRAME_MS)
+    search_frames = int(search_s * 1000 / FRAME_MS)
+    cuts = [0]
+    target = frames_per_segment
+    while target < frame_count - search_frames:
+        low = max(cuts[-1] + 1, target - search_frames)
+        high = min(frame_count, target + search_frames)
+        cut = low + int(np.argmin(energy[low:high]))
+        cuts.append(cut)
+        target = cut + frames_per_segment
+    return [cut * frame_length for cut in cuts] + [len(samples)]
+
+
+def to_wav(samples):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def get_file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_key(audio_digest, transcriber_name, **params):
+    request = {"audio": audio_digest, "transcriber": transcriber_name, **params}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:04.1f}"
+
+
+def format_transcript(segments):
+    return "\n".join(
+        f"[{format_time(segment['start'])} - {format_time(segment['end'])}] {segment['text']}"
+        for segment in segments if segment["text"]
+    )
+
+
+async def transcribe_file(path, transcriber=None, concurrency=None, segment_s=None, search_s=None):
+    """Transcribe an audio file in silence-aligned segments, several at a time.
+
+    Returns:
+        list: {"start", "end", "text"} dicts in order, with times in seconds. Both the whole
+        transcript and each segment are cached by a hash of the audio, so a re-run of the same
+        file costs nothing, and a re-run after a failure only sends the segments still missing.
+    """
+    transcriber = transcriber or get_transcriber()
+    concurrency = concurrency or config.get("transcription_concurrency", 4)
+    segment_s = segment_s or config.get("transcription_segment_s", 120)
+    search_s = search_s or config.get("transcription_search_s", 10)
+
+    file_key = make_key(get_file_digest(path), transcriber.name, segment_s=segment_s, search_s=search_s)
+    cached = cache.get_bytes(file_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    samples = await asyncio.to_thread(decode_audio, path)
+    cuts = find_cuts(samples, segment_s, search_s)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def transcribe_segment(start, end):
+        wav_bytes = to_wav(samples[start:end])
+        segment_key = make_key(hashlib.sha256(wav_bytes).hexdigest(), transcriber.name)
+        cached = cache.get_bytes(segment_key)
+        if cached is not None:
+            text = json.loads(cached)
+        else:
+            async with semaphore:
+                text = await transcriber.transcribe(wav_bytes)
+            cache.put_bytes(segment_key, json.dumps(text, ensure_ascii=False).encode("utf-8"))
+        return {"start": start / SAMPLE_RATE, "end": end / SAMPLE_RATE, "text": text}
+
+    segments = await asyncio.gather(*(transcribe_segment(start, end) for start, end in zip(cuts, cuts[1:])))
+    cache.put_bytes(file_key, json.dumps(segments, ensure_ascii=False).encode("utf-8"))
+    return segments
+
+
+def get_transcription(file_name, endpoint=None):
+    """Transcribe ./data/<file_name> and save the timestamped transcript next to it."""
+    path = f"{config['data_dir']}/{file_name}"
+    start = time.perf_counter()
+    segments = asyncio.run(transcribe_file(path, get_transcriber(endpoint)))
+    transcript = format_transcript(segments)
+    print(transcript)
+    print(f"Transcribed {len(segments)} segments in {time.perf_counter() - start:.1f}s")
+    with open(f"{path}.txt", "w", encoding="utf-8") as f:
+        f.write(transcript)
+    return transcript
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe an audio file in the data directory.")
+    parser.add_argument("file_name", help="audio file in the data directory, in any format ffmpeg can read")
+    parser.add_argument("--endpoint", choices=["openai", "vosk"], default=None, help="transcription endpoint, defaults to the config file")
+    args = parser.parse_args()
+    get_transcription(args.file_name, args.endpoint)
+
+
+###### Global Vars ######
+cache = DiskCache(
+    config.get("transcription_cache_dir", "./data/cache/transcripts"),
+    config.get("transcription_cache_max_mb", 64) * 1024 * 1024,
+    extension=".json",
+)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+###### Standard Imports ######
+import hashlib
+import json
+
+###### Local Imports ######
+from disk_cache import DiskCache
+from settings import config
+
+###### Global Vars ######
+QUOTE_TRANSLATION = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+
+###### Functions ######
+
+def normalize_text(text):
+    """Collapse whitespace and curly quotes, which don't change the speech, so more sentences share an entry.
+    Case and punctuation are kept since they affect the delivery."""
+    return " ".join(text.translate(QUOTE_TRANSLATION).split())
+
+
+def make_key(text, voice_id, model_id, voice_settings, output_format):
+    request = {
+        "text": normalize_text(text),
+        "voice_id": voice_id,
+        "model_id": model_id,
+        "voice_settings": voice_settings,
+        "output_format": output_format,
+    }
+    encoded = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def get(text, voice_id, model_id, voice_settings, output_format):
+    """Return the cached audio for a sentence, or None."""
+    if not normalize_text(text):
+        return None
+    return cache.get_bytes(make_key(text, voice_id, model_id, voice_settings, output_format))
+
+
+def put(text, voice_id, model_id, voice_settings, output_format, audio_bytes):
+    if not normalize_text(text) or not audio_bytes:
+        return
+    cache.put_bytes(make_key(text, voice_id, model_id, voice_settings, output_format), audio_bytes)
+
+
+###### Global Vars ######
+cache = DiskCache(config["tts_cache_dir"], config["tts_cache_max_mb"] * 1024 * 1024, extension=".audio")
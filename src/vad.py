@@ -0,0 +1,114 @@
+###### Standard Imports ######
+import collections
+
+###### Third-Party Imports ######
+import numpy as np
+
+
+###### Classes ######
+
+class EnergyVad:
+    """Energy and zero-crossing voice activity detector for 16-bit mono PCM.
+
+    Audio is split into short frames, and the RMS energy and zero-crossing rate of every frame
+    in a block are computed at once with NumPy. A frame counts as speech when its energy is
+    well above the running noise floor and its zero-crossing rate is below that of hiss.
+    Speech keeps the gate open for hangover_ms after the last speech frame, so word endings
+    and short pauses aren't cut off. The preroll_ms of audio before the gate opens is sent
+    along with the speech, so the first syllable isn't lost either.
+    """
+
+    def __init__(
+        self,
+        sample_rate,
+        frame_ms=30,
+        hangover_ms=600,
+        preroll_ms=300,
+        min_rms=300,
+        noise_ratio=3.0,
+        max_zcr=0.35,
+    ):
+        self.frame_length = int(sample_rate * frame_ms / 1000)
+        self.hangover_frames = max(1, int(hangover_ms / frame_ms))
+        self.min_rms = min_rms
+        self.noise_ratio = noise_ratio
+        self.max_zcr = max_zcr
+        self.noise_floor = float(min_rms) / noise_ratio
+        self.preroll = collections.deque(maxlen=max(1, int(preroll_ms / frame_ms)))
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.hangover = 0
+        self.in_speech = False
+
+        # Counters for reporting how much audio never reached the recognizer
+        self.total_frames = 0
+        self.forwarded_frames = 0
+
+    def classify(self, frames):
+        """Return a boolean speech decision for each row of a (frames, frame_length) array."""
+        samples = frames.astype(np.float32)
+        rms = np.sqrt(np.mean(samples * samples, axis=1))
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        threshold = max(self.min_rms, self.noise_floor * self.noise_ratio)
+        speech = (rms > threshold) & (zcr < self.max_zcr)
+
+        # Let the noise floor follow the quiet frames, slowly
+        quiet = rms[~speech]
+        if len(quiet):
+            self.noise_floor = 0.95 * self.noise_floor + 0.05 * float(np.median(quiet))
+        return speech
+
+    def process(self, data):
+        """Feed a block of PCM bytes.
+
+        Returns:
+            list: (speech bytes, ended) pairs in order, to pass to the recognizer. ended is True
+            when the speech segment finished within the block, meaning the recognizer should
+            finalize its result after taking the bytes.
+        """
+        samples = np.concatenate([self.remainder, np.frombuffer(data, dtype=np.int16)])
+        frame_count = len(samples) // self.frame_length
+        usable = frame_count * self.frame_length
+        self.remainder = samples[usable:]
+        if frame_count == 0:
+            return []
+
+        frames = samples[:usable].reshape(frame_count, self.frame_length)
+        decisions = self.classify(frames)
+        self.total_frames += frame_count
+
+        segments = []
+        forward = []
+        for frame, is_speech in zip(frames, decisions):
+            if is_speech:
+                if not self.in_speech:
+                    self.in_speech = True
+                    forward.extend(self.preroll)
+                    self.preroll.clear()
+                self.hangover = self.hangover_frames
+            elif self.in_speech:
+                self.hangover -= 1
+                if self.hangover <= 0:
+                    self.in_speech = False
+                    segments.append((forward, True))
+                    forward = []
+
+            if self.in_speech:
+                forward.append(frame)
+            else:
+                self.preroll.append(frame)
+        if forward:
+            segments.append((forward, False))
+
+        result = []
+        for segment_frames, ended in segments:
+            self.forwarded_frames += len(segment_frames)
+            data = np.concatenate(segment_frames).tobytes() if segment_frames else b""
+            result.append((data, ended))
+        return result
+
+    @property
+    def skipped_fraction(self):
+        if self.total_frames == 0:
+            return 0.0
+        return 1 - self.forwarded_frames / self.total_frames
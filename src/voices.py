@@ -0,0 +1,13 @@
+# ElevenLabs voice IDs by persona name. Kept apart from xi_labs so that code which
+# only needs the names, like the chat server, doesn't import the audio stack.
+voices = {
+    "michael": "d5p9QsIisbcRbI3NQ5FR",
+    "samantha": "bjehOvr3TnhggNkXv7bp",
+    "sally": "09AoN6tYyW3VSTQqCo7C",
+    "nina": "P2GZl52xQmbWlMkeefio",
+    "tiffany": "x9leqCOAXOcmC5jtkq65",
+    "ilya": "CnV6BQOHeZCIv4McSXDH",
+    "cheryl": "wVZ5qbJFYF3snuC65nb4",
+    "jennifer": "7NEwj4nuis0eiAI9AhKF",
+    "elizabeth": "LGGSADQ2UFf7xNvljNZp"
+}
@@ -0,0 +1,72 @@
+###### Standard Imports ######
+import re
+
+
+###### Classes ######
+
+class WakeWordMatcher:
+    """Finds any of a set of wake words in a transcript with one compiled regular expression.
+
+    Words are matched whole and case-insensitively. Longer words are tried first, so a name that
+    contains another name is not cut short.
+    """
+
+    def __init__(self, words):
+        self.words = set()
+        self.pattern = None
+        self.update(words)
+
+    def update(self, words):
+        """Add words to the matcher, recompiling the pattern only if something new was added."""
+        words = {word.lower() for word in words if word}
+        if words <= self.words:
+            return
+        self.words |= words
+        alternatives = "|".join(re.escape(word) for word in sorted(self.words, key=len, reverse=True))
+        self.pattern = re.compile(rf"\b({alternatives})\b", re.IGNORECASE)
+
+    def search(self, text):
+        """Return (word, end) for the first wake word in text, or None. end is where the prompt starts."""
+        if self.pattern is None or not text:
+            return None
+        match = self.pattern.search(text)
+        if match is None:
+            return None
+        return match.group(1).lower(), match.end()
+
+
+class PartialWakeDetector:
+    """Fires on a wake word as soon as it holds still across consecutive partial transcripts.
+
+    The recognizer keeps revising the start of a partial while the user is speaking, so a word
+    only counts once it has been seen at the same position stable_partials times in a row.
+    """
+
+    def __init__(self, matcher, stable_partials=2):
+        self.matcher = matcher
+        self.stable_partials = stable_partials
+        self.reset()
+
+    def reset(self):
+        self.candidate = None
+        self.count = 0
+        self.fired = None
+
+    def feed(self, text):
+        """Feed a partial transcript. Returns the wake word the first time it becomes stable, else None."""
+        if self.fired is not None:
+            return None
+        match = self.matcher.search(text)
+        if match is None:
+            self.candidate = None
+            self.count = 0
+            return None
+        if match == self.candidate:
+            self.count += 1
+        else:
+            self.candidate = match
+            self.count = 1
+        if self.count >= self.stable_partials:
+            self.fired = match[0]
+            return self.fired
+        return None
@@ -2,23 +2,17 @@ import requests
 import json
 import asyncio
 import base64
+import collections
+import time
 import websockets
 import yaml
 
 import audio
 import settings
+import tts_cache
+from chunker import ChunkPolicy, TextChunker, SENTENCE
+from voices import voices
 
-voices = {
-    "michael": "d5p9QsIisbcRbI3NQ5FR",
-    "samantha": "bjehOvr3TnhggNkXv7bp",
-    "sally": "09AoN6tYyW3VSTQqCo7C",
-    "nina": "P2GZl52xQmbWlMkeefio",
-    "tiffany": "x9leqCOAXOcmC5jtkq65",
-    "ilya": "CnV6BQOHeZCIv4McSXDH",
-    "cheryl": "wVZ5qbJFYF3snuC65nb4",
-    "jennifer": "7NEwj4nuis0eiAI9AhKF",
-    "elizabeth": "LGGSADQ2UFf7xNvljNZp"
-}
 
 
 def get_voice_list():
@@ -47,19 +41,44 @@ def get_voice_list():
         # These keys in the voice dictionary contain values that provide information about the specific voice.
         print(f"{voice['name']}; {voice['voice_id']}")
 
-def text_to_speech(
-    text, 
-    output_path="output.mp3", 
-    voice_id=voices["michael"]
-):
-    # Define constants for the script
-    CHUNK_SIZE = 1024  # Size of chunks to read/write at a time
-    VOICE_ID = voice_id  # ID of the voice model to use
-    TEXT_TO_SPEAK = text  # Text you want to convert to speech
-    OUTPUT_PATH = output_path  # Path to save the output audio file
+REST_MODEL_ID = "eleven_multilingual_v2"
+STREAM_MODEL_ID = "eleven_monolingual_v1"
+# Chunks at most this long are cached when they were spoken over the websocket
+MAX_CACHED_CHUNK_CHARS = 200
+# What text_to_speech saves, whatever the streaming output is
+FILE_OUTPUT_FORMAT = "mp3_44100_128"
+
+
+def get_output_format():
+    if settings.config.get("audio_output", "mpv") == "pcm":
+        # Raw samples for audio.PcmPlayer instead of the default MP3 stream
+        return f"pcm_{settings.config['pcm_sample_rate']}"
+    return "mp3_44100_128"
+
+
+def get_bytes_per_second(output_format):
+    """How many bytes of an output format make a second of audio, e.g. mp3_44100_128 or pcm_22050."""
+    codec, sample_rate, *bitrate = output_format.split("_")
+    if codec == "pcm":
+        return int(sample_rate) * 2
+    return int(bitrate[0]) * 1000 // 8
+
+
+def split_sentences(text):
+    chunker = TextChunker(ChunkPolicy(SENTENCE))
+    sentences = chunker.feed(text)
+    sentences.append(chunker.flush())
+    return [sentence for sentence in sentences if sentence.strip()]
+
+
+def synthesize_sentence(text, voice_id, voice_settings, model_id=REST_MODEL_ID, output_format=FILE_OUTPUT_FORMAT):
+    """Return the audio for one sentence, from the TTS cache if it has been synthesized before."""
+    cached = tts_cache.get(text, voice_id, model_id, voice_settings, output_format)
+    if cached is not None:
+        return cached
 
     # Construct the URL for the Text-to-Speech API request
-    tts_url = f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}/stream"
+    tts_url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream?output_format={output_format}"
 
     # Set up headers for the API request, including the API key for authentication
     headers = {
@@ -69,31 +88,161 @@ def text_to_speech(
 
     # Set up the data payload for the API request, including the text and voice settings
     data = {
-        "text": TEXT_TO_SPEAK,
-        "model_id": "eleven_multilingual_v2",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.8,
-            "style": 0.0,
-            "use_speaker_boost": True
-        }
+        "text": text.strip(),
+        "model_id": model_id,
+        "voice_settings": voice_settings
     }
 
-    # Make the POST request to the TTS API with headers and data, enabling streaming response
-    response = requests.post(tts_url, headers=headers, json=data, stream=True)
+    response = requests.post(tts_url, headers=headers, json=data)
 
     # Check if the request was successful
-    if response.ok:
-        # Open the output file in write-binary mode
-        with open(OUTPUT_PATH, "wb") as f:
-            # Read the response in chunks and write to the file
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                f.write(chunk)
-        # Inform the user of success
-        print("Audio stream saved successfully.")
-    else:
+    if not response.ok:
         # Print the error message if the request was not successful
         print(response.text)
+        return None
+
+    tts_cache.put(text, voice_id, model_id, voice_settings, output_format, response.content)
+    return response.content
+
+
+def text_to_speech(
+    text, 
+    output_path="output.mp3", 
+    voice_id=voices["michael"]
+):
+    """Synthesize text sentence by sentence, so that sentences already in the TTS cache
+    aren't sent to the API again, and save the combined audio to output_path."""
+    voice_settings = get_voice_settings(stability=0.5, similarity_boost=0.8)
+
+    # Open the output file in write-binary mode
+    with open(output_path, "wb") as f:
+        for sentence in split_sentences(text):
+            audio_bytes = synthesize_sentence(sentence, voice_id, voice_settings)
+            if audio_bytes is None:
+                return
+            f.write(audio_bytes)
+    # Inform the user of success
+    print("Audio stream saved successfully.")
+
+
+def get_stream_uri(voice_id):
+    uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input?model_id={STREAM_MODEL_ID}"
+    # Keep unused connections open long enough to be worth opening ahead of time
+    uri += f"&inactivity_timeout={settings.config.get('xi_ws_inactivity_timeout_s', 20)}"
+    uri += f"&output_format={get_output_format()}"
+    # Character timings come with every audio message, so its audio can be matched to the chunks
+    uri += "&sync_alignment=true"
+    return uri
+
+
+class ConnectionPool:
+    """Stream-input websockets that are opened and handshaked before they are needed.
+
+    A stream-input connection carries a single generation, so each one is handed out once.
+    prewarm() starts opening a connection in the background, e.g. while the chat completion
+    request is in flight, and acquire() takes it, opening one on the spot if there is none.
+    Connections left unused for longer than max_idle_s are closed and replaced, since
+    ElevenLabs drops them after its inactivity timeout.
+    """
+
+    def __init__(self, max_idle_s):
+        self.max_idle_s = max_idle_s
+        self.connections = {}  # (voice_id, voice settings) -> task opening a connection
+
+    async def _open(self, voice_id, voice_settings):
+        websocket = await websockets.connect(get_stream_uri(voice_id))
+        await websocket.send(json.dumps({
+            "text": " ",
+            "voice_settings": dict(voice_settings),
+            "xi_api_key": settings.XI_LABS_API_KEY,
+        }))
+        return websocket, time.monotonic()
+
+    def _is_stale(self, task):
+        if not task.done():
+            return False
+        if task.cancelled() or task.exception() is not None:
+            return True
+        websocket, opened_at = task.result()
+        return websocket.closed or time.monotonic() - opened_at > self.max_idle_s
+
+    def _discard(self, task):
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            asyncio.create_task(task.result()[0].close())
+
+    def prewarm(self, voice_id, **voice_settings):
+        """Start opening a connection for the voice in the background, unless a fresh one is ready."""
+        key = (voice_id, tuple(sorted(voice_settings.items())))
+        task = self.connections.get(key)
+        if task is not None and not self._is_stale(task):
+            return
+        if task is not None:
+            self._discard(task)
+        self.connections[key] = asyncio.create_task(self._open(*key))
+
+    async def acquire(self, voice_id, **voice_settings):
+        """Take a handshaked connection for the voice."""
+        self.prewarm(voice_id, **voice_settings)
+        key = (voice_id, tuple(sorted(voice_settings.items())))
+        task = self.connections.pop(key)
+        websocket, _ = await task
+        return websocket
+
+    async def close(self):
+        for task in self.connections.values():
+            self._discard(task)
+        self.connections = {}
+
+
+pool = ConnectionPool(settings.config.get("xi_ws_inactivity_timeout_s", 20) - 5)
+
+
+def get_voice_settings(stability=0.4, similarity_boost=0.9, style=0.0, use_speaker_boost=True):
+    return {
+        "stability": stability,
+        "similarity_boost": similarity_boost,
+        "style": style,
+        "use_speaker_boost": use_speaker_boost
+    }
+
+
+def prewarm(voice_id, **kwargs):
+    """Open the websocket for a voice ahead of text_to_speech_input_streaming, with the same voice settings."""
+    pool.prewarm(voice_id, **get_voice_settings(**kwargs))
+
+
+class SpokenChunk:
+    """A chunk of a streamed reply and its audio, which comes from the TTS cache or the websocket.
+
+    The websocket voices the chunks in the order they were sent, and each audio message says
+    which characters it covers, so the characters are counted off against the chunks to tell
+    when a chunk's audio is complete.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.audio = asyncio.Queue()  # Audio bytes for playback, then None
+        self.parts = []
+        self.expected = "".join(text.split())
+        self.voiced = []
+        self.cacheable = True
+        self.starts_at = None  # Where its audio starts in the player's output, in seconds
+
+    @property
+    def chars_left(self):
+        return len(self.expected) - len(self.voiced)
+
+    def add_audio(self, audio_bytes):
+        self.parts.append(audio_bytes)
+        self.audio.put_nowait(audio_bytes)
+
+    def finish(self):
+        self.audio.put_nowait(None)
+
+    def is_complete(self):
+        return self.cacheable and "".join(self.voiced) == self.expected
 
 
 async def text_to_speech_input_streaming(
@@ -103,49 +252,138 @@ async def text_to_speech_input_streaming(
     stability=0.4,
     similarity_boost=0.9,
     style=0.0,
-    use_speaker_boost=True
+    use_speaker_boost=True,
+    timer=None,
+    heard=None
 ):
-    """Send text to ElevenLabs API and stream the returned audio."""
-    uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input?model_id=eleven_monolingual_v1"
+    """Send text to ElevenLabs API and stream the returned audio.
+    If a latency.TurnTimer is passed, the first chunk sent and first audio frame are marked on it.
+    If a heard list is passed, the text of each chunk that started playing is appended to it
+    when the reply ends or is cut short.
+
+    Chunks found in the TTS cache are played straight from it, and only the others are sent
+    over the websocket. Each of those is flushed as it is sent, so its audio isn't mixed with
+    the next chunk's, and once all of it has arrived it is cached under the chunk's text.
+
+    If the calling task is cancelled, the websocket is closed and playback stops immediately.
+    """
+    voice_settings = get_voice_settings(stability, similarity_boost, style, use_speaker_boost)
+    output_format = get_output_format()
+    chunks = asyncio.Queue()        # SpokenChunks in the order they are played, then None
+    awaiting = collections.deque()  # Chunks sent over the websocket and not yet fully voiced
+    played = []                     # Chunks whose audio has been handed to the player
+
+    async def playback():
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            while True:
+                audio_bytes = await chunk.audio.get()
+                if audio_bytes is None:
+                    break
+                if chunk.starts_at is None:
+                    chunk.starts_at = audio.player.written_seconds()
+                    played.append(chunk)
+                yield audio_bytes
+
+    def note_heard():
+        if heard is not None:
+            position = audio.player.played_seconds()
+            heard.extend(chunk.text for chunk in played if chunk.starts_at < position)
+
+    def finish_voiced(chunk):
+        chunk.finish()
+        if chunk.is_complete() and len(chunk.text) <= MAX_CACHED_CHUNK_CHARS:
+            tts_cache.put(chunk.text, voice_id, STREAM_MODEL_ID, voice_settings, output_format, b"".join(chunk.parts))
+
+    play_task = asyncio.create_task(audio.stream(playback(), timer=timer, bytes_per_second=get_bytes_per_second(output_format)))
+    websocket = None
+    listen_task = None
+
+    async def listen():
+        """Listen to the websocket for audio data and hand it to the chunks being voiced."""
+        while True:
+            try:
+                message = await websocket.recv()
+            except websockets.exceptions.ConnectionClosed:
+                print("Connection closed")
+                break
+            data = json.loads(message)
+            if data.get("audio") and awaiting:
+                if timer is not None:
+                    timer.mark("first_audio_frame")
+                awaiting[0].add_audio(base64.b64decode(data["audio"]))
+                alignment = data.get("alignment") or {}
+                chars = [char for char in alignment.get("chars") or [] if not char.isspace()]
+                while chars and awaiting:
+                    chunk = awaiting[0]
+                    taken, chars = chars[:chunk.chars_left], chars[chunk.chars_left:]
+                    chunk.voiced.extend(taken)
+                    if chunk.chars_left == 0:
+                        awaiting.popleft()
+                        if chars and awaiting:
+                            # This audio runs on into the next chunk, so neither can be cached alone
+                            chunk.cacheable = awaiting[0].cacheable = False
+                        finish_voiced(chunk)
+            elif data.get('isFinal'):
+                break
+        # Whatever is still waiting was cut off, so it is played but not cached
+        while awaiting:
+            awaiting.popleft().finish()
 
     try:
-        async with websockets.connect(uri) as websocket:
-            await websocket.send(json.dumps({
-                "text": " ",
-                "voice_settings": 
-                {
-                    "stability":stability,
-                    "similarity_boost": similarity_boost,
-                    "style": style,
-                    "use_speaker_boost": use_speaker_boost
-                },
-                "xi_api_key": settings.XI_LABS_API_KEY,
-            }))
-
-            async def listen():
-                """Listen to the websocket for audio data and stream it."""
-                while True:
-                    try:
-                        message = await websocket.recv()
-                        data = json.loads(message)
-                        if data.get("audio"):
-                            yield base64.b64decode(data["audio"])
-                        elif data.get('isFinal'):
-                            break
-                    except websockets.exceptions.ConnectionClosed:
-                        print("Connection closed")
-                        break
-
-            listen_task = asyncio.create_task(audio.stream(listen()))
-
-            async for text in text_chunker_fn(text_iterator):
-                await websocket.send(json.dumps({"text": text, "try_trigger_generation": True}))
+        async for text in text_chunker_fn(text_iterator):
+            chunk = SpokenChunk(text)
+            cached = tts_cache.get(text, voice_id, STREAM_MODEL_ID, voice_settings, output_format)
+            if cached is not None or not chunk.expected:
+                if cached is not None:
+                    if timer is not None:
+                        timer.mark("first_chunk_sent")
+                        timer.mark("first_audio_frame")
+                    chunk.add_audio(cached)
+                chunk.finish()
+                chunks.put_nowait(chunk)
+                continue
 
-            await websocket.send(json.dumps({"text": ""}))
+            if websocket is None:
+                websocket = await pool.acquire(voice_id, **voice_settings)
+                listen_task = asyncio.create_task(listen())
+            chunks.put_nowait(chunk)
+            awaiting.append(chunk)
+            await websocket.send(json.dumps({"text": text, "flush": True}))
+            if timer is not None:
+                timer.mark("first_chunk_sent")
 
+        if websocket is not None:
+            await websocket.send(json.dumps({"text": ""}))
             await listen_task
+            await websocket.close()
+
+        # Playing out the reply is part of the turn, so a barge-in can cut it short too
+        chunks.put_nowait(None)
+        await play_task
+        note_heard()
     except asyncio.TimeoutError:
         print("Connection timed out.")
+    except asyncio.CancelledError:
+        # Barge-in: silence the reply now rather than playing out what is buffered
+        note_heard()
+        play_task.cancel()
+        await asyncio.gather(play_task, return_exceptions=True)
+        await audio.player.flush()
+        raise
+    finally:
+        if listen_task is not None and not listen_task.done():
+            listen_task.cancel()
+        if websocket is not None:
+            await websocket.close()
+        if not play_task.done():
+            while awaiting:
+                awaiting.popleft().finish()
+            chunks.put_nowait(None)
+            await play_task
+
 
 if __name__ == "__main__":
     get_voice_list()
\ No newline at end of file